@@ -2,6 +2,7 @@ import json
 import logging
 import os
 from datetime import datetime
+from datetime import timezone
 
 from flask import Request
 from flask import Response
@@ -12,6 +13,62 @@ from utils import get_package_version
 
 
 class ASIMFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__()
+        self._last_time_seconds = None
+        self._last_time_prefix = ""
+        # None of these change over the life of the process, so they are
+        # computed once rather than per record
+        self._package_version = None
+        self._static_log_fields = {
+            "EventCount": 1,
+            "EventType": "HTTPsession",
+            "EventSchema": "WebSession",
+            "EventSchemaVersion": "0.2.6",
+        }
+        # When set, the env var is a comma-separated string; parsing it here
+        # also fixes the previous behaviour of iterating it character by
+        # character on every record
+        raw_trace_headers = os.environ.get("DLFA_TRACE_HEADERS")
+        self._trace_headers = (
+            tuple(header.strip() for header in raw_trace_headers.split(","))
+            if raw_trace_headers
+            else ("X-Amzn-Trace-Id",)
+        )
+
+    def _get_package_version(self) -> str:
+        if self._package_version is None:
+            self._package_version = get_package_version()
+
+        return self._package_version
+
+    def _format_time(self, created: float) -> str:
+        """Format a record timestamp as an ISO string, caching the
+        whole-second prefix so bursts of records in the same second only pay
+        for formatting the microseconds."""
+        seconds = int(created)
+        microseconds = round((created - seconds) * 1_000_000)
+
+        if microseconds >= 1_000_000:
+            seconds += 1
+            microseconds -= 1_000_000
+
+        if seconds != self._last_time_seconds:
+            self._last_time_seconds = seconds
+            # fromtimestamp with an explicit zone rather than the deprecated
+            # utcfromtimestamp; tzinfo is dropped again so the rendered string
+            # stays the bare ISO form the schema expects
+            self._last_time_prefix = (
+                datetime.fromtimestamp(seconds, tz=timezone.utc)
+                .replace(tzinfo=None)
+                .isoformat()
+            )
+
+        if microseconds:
+            return f"{self._last_time_prefix}.{microseconds:06d}"
+
+        return self._last_time_prefix
+
     def _get_event_result(self, response: Response) -> str:
         event_result = "Success" if response.status_code < 400 else "Failure"
 
@@ -36,19 +93,16 @@ class ASIMFormatter(logging.Formatter):
         return map[log_level]
 
     def get_log_dict(self, record: logging.LogRecord) -> dict:
-        log_time = datetime.utcfromtimestamp(record.created).isoformat()
+        log_time = self._format_time(record.created)
 
         return {
             "EventMessage": record.msg,
-            "EventCount": 1,
+            **self._static_log_fields,
             "EventStartTime": log_time,
             "EventEndTime": log_time,
-            "EventType": "HTTPsession",
             "EventSeverity": self._get_event_severity(record.levelname),
             "EventOriginalSeverity": record.levelname,  # duplicate of above?
-            "EventSchema": "WebSession",
-            "EventSchemaVersion": "0.2.6",
-            "IpFilterVersion": get_package_version(),
+            "IpFilterVersion": self._get_package_version(),
         }
 
         # TODO: look at expanding to include other fields from schema: https://learn.microsoft.com/en-us/azure/sentinel/normalization-schema-web
@@ -67,15 +121,13 @@ class ASIMFormatter(logging.Formatter):
             "HttpResponseTime": "N/A",
             "HttpHost": request.host,
             "AdditionalFields": {
-                "TraceHeaders": {},
+                "TraceHeaders": {
+                    trace_header: request.headers.get(trace_header, None)
+                    for trace_header in self._trace_headers
+                },
             },
         }
 
-        for trace_header in os.environ.get("DLFA_TRACE_HEADERS", ("X-Amzn-Trace-Id",)):
-            request_dict["AdditionalFields"]["TraceHeaders"][
-                trace_header
-            ] = request.headers.get(trace_header, None)
-
         return request_dict
 
     def get_response_dict(self, response: Response) -> dict:
@@ -89,12 +141,20 @@ class ASIMFormatter(logging.Formatter):
     def format(self, record: logging.LogRecord) -> str:
         log_dict = self.get_log_dict(record)
 
-        if has_request_context():
-            request_dict = self.get_request_dict(request)
-            log_dict = log_dict | request_dict
+        # A record that was handed off to the logging queue carries a snapshot
+        # of the request taken on the request thread, as there is no request
+        # context on the listener thread
+        record_request = getattr(record, "request", None)
+
+        if record_request is None and has_request_context():
+            record_request = request
+
+        # update() in place rather than `|`, which allocates a new dict per
+        # merge
+        if record_request is not None:
+            log_dict.update(self.get_request_dict(record_request))
 
         if hasattr(record, "response"):
-            response_dict = self.get_response_dict(record.response)
-            log_dict = log_dict | response_dict
+            log_dict.update(self.get_response_dict(record.response))
 
         return json.dumps(log_dict)
@@ -1,3 +1,6 @@
+import hashlib
+import socket
+import time
 from collections import UserDict
 from ipaddress import ip_network
 from urllib.parse import urljoin
@@ -8,18 +11,34 @@ from schema import Optional
 from schema import Schema
 from schema import SchemaError
 
+try:
+    # The C-backed loader parses several times faster than the pure-Python one
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+
+# Shared across calls so requests to the AppConfig agent can reuse
+# connections instead of building a new pool per call
+_appconfig_http = urllib3.PoolManager()
+
 
 class Environ(UserDict):
     """Handle app configuration from os.environ with support for copilot
     environment specific configuration and type conversion."""
 
-    def get_value(self, key, /, default=None, allow_environment_override=False):
-        environment = self.data["COPILOT_ENVIRONMENT_NAME"].upper()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The deployment environment is fixed for the life of the process, so
+        # the override prefix is computed once rather than on every lookup
+        self._override_prefix = f'{self.data["COPILOT_ENVIRONMENT_NAME"].upper()}_'
 
-        overridden_key = f"{environment.upper()}_{key}"
+    def get_value(self, key, /, default=None, allow_environment_override=False):
+        if allow_environment_override:
+            overridden_key = self._override_prefix + key
 
-        if allow_environment_override and overridden_key in self.data:
-            return self.data[overridden_key]
+            if overridden_key in self.data:
+                return self.data[overridden_key]
 
         if key in self.data:
             return self.data[key]
@@ -82,7 +101,7 @@ def get_appconfig_configuration(appconfig_path):
     )
 
     try:
-        response = urllib3.PoolManager().request(
+        response = _appconfig_http.request(
             "GET",
             url=url,
         )
@@ -90,7 +109,7 @@ def get_appconfig_configuration(appconfig_path):
         raise AppConfigError(ex)
 
     if response.status == 200:
-        return yaml.safe_load(response.data)
+        return yaml.load(response.data, Loader=YamlLoader)
 
     raise AppConfigError(f"AppConfig for {appconfig_path} not found.")
 
@@ -116,6 +135,23 @@ APPCONFIG_SCHEMA = Schema(
 )
 
 
+# Hop-by-hop headers (RFC 9110 section 7.6.1) are meaningful for a single
+# connection only, so they are never forwarded to the origin. Transfer-Encoding
+# is deliberately absent: the proxy forwards the client's framing so chunked
+# uploads stay chunked at the origin.
+HOP_BY_HOP_HEADERS = frozenset(
+    [
+        "connection",
+        "keep-alive",
+        "proxy-authenticate",
+        "proxy-authorization",
+        "te",
+        "trailers",
+        "upgrade",
+    ]
+)
+
+
 class ValidationError(Exception):
     pass
 
@@ -124,9 +160,83 @@ class AppConfigError(Exception):
     pass
 
 
-def get_ipfilter_config(appconfig_paths: list[str]):
+def build_network_table(networks):
+    """Pack parsed networks into (version, address, netmask) integer tuples so
+    containment checks reduce to a bitmask comparison, with no ipaddress
+    machinery on the per-request path."""
+    return tuple(
+        (network.version, int(network.network_address), int(network.netmask))
+        for network in networks
+    )
+
+
+def parse_ip(ip_string):
+    """Parse an address string into a (version, integer) pair using C-level
+    socket parsing, or None if it isn't a valid address.
+
+    inet_pton only accepts strict dotted-quad/RFC 4291 forms, matching what
+    ipaddress.ip_address would have allowed."""
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip_string), "big")
+    except OSError:
+        pass
+
+    try:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip_string), "big")
+    except OSError:
+        return None
+
+
+def ip_in_networks(version, address, network_table):
+    """Return whether a parsed (version, integer) client address falls within
+    any network in a packed table built by build_network_table."""
+    return any(
+        net_version == version and address & netmask == network
+        for net_version, network, netmask in network_table
+    )
+
+
+def _build_auth_index(auth):
+    """Index basic-auth entries by (path, username digest), mapping to every
+    password digest configured for that pair.
+
+    Duplicate entries for the same path and username are all kept, so a
+    config that lists an old and a new password during rotation accepts
+    either.
+    """
+    index = {}
+
+    for entry in auth:
+        key = (entry["Path"], hashlib.sha256(entry["Username"].encode()).digest())
+        index.setdefault(key, []).append(
+            hashlib.sha256(entry["Password"].encode()).digest()
+        )
+
+    return {key: tuple(digests) for key, digests in index.items()}
+
+
+_ipfilter_config_cache = {}
+
+
+def clear_ipfilter_config_cache():
+    """Discard any cached AppConfig data, forcing a refetch on the next call
+    to get_ipfilter_config."""
+    _ipfilter_config_cache.clear()
+
+
+def get_ipfilter_config(appconfig_paths: list[str], ttl: int = 30):
     """Retrieve a list of app config configurations and combine them into a
-    single dict."""
+    single dict.
+
+    The combined dict is cached for `ttl` seconds so the AppConfig agent is
+    not queried on every request.
+    """
+    cache_key = tuple(appconfig_paths)
+    cached = _ipfilter_config_cache.get(cache_key)
+
+    if cached is not None and time.monotonic() < cached[0]:
+        return cached[1]
+
     ips = []
     auth = []
     shared_tokens = []
@@ -141,8 +251,40 @@ def get_ipfilter_config(appconfig_paths: list[str]):
         auth.extend(config.get("BasicAuth", []))
         shared_tokens.extend(config.get("SharedTokens", []))
 
-    return {
+    rules = {
         "ips": ips,
+        # Parsed and packed once here so the per-request whitelist check is
+        # integer math rather than ip_network construction.
+        "network_table": build_network_table(
+            ip_network(ip_range) for ip_range in ips
+        ),
         "auth": auth,
         "shared_tokens": shared_tokens,
+        # Headers stripped before proxying to the origin; this only depends
+        # on the shared tokens, so it is built once per config fetch rather
+        # than per request.
+        "headers_to_remove": HOP_BY_HOP_HEADERS.union(
+            shared_token["HeaderName"].lower() for shared_token in shared_tokens
+        ),
+        # Server-side secrets are hashed once per fetch. Per-request
+        # comparisons then run over fixed-length 32-byte digests, which keeps
+        # compare_digest length-independent of the real secret and avoids
+        # holding the plaintext alongside every check
+        "shared_token_checks": tuple(
+            (
+                shared_token["HeaderName"],
+                hashlib.sha256(shared_token["Value"].encode()).digest(),
+            )
+            for shared_token in shared_tokens
+        ),
+        # Keyed on (path, username digest) so the on-path credential check is
+        # a single dict probe rather than a scan over every configured entry.
+        # auth_paths records which paths have any entry at all, which decides
+        # whether to challenge with a 401.
+        "auth_index": _build_auth_index(auth),
+        "auth_paths": frozenset(entry["Path"] for entry in auth),
     }
+
+    _ipfilter_config_cache[cache_key] = (time.monotonic() + ttl, rules)
+
+    return rules
@@ -1,25 +1,31 @@
+import atexit
 import logging
 import os
-import string
+import queue
+import re
+import secrets
 import sys
-from ipaddress import ip_address
+from hashlib import sha256
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
 from ipaddress import ip_network
 from pathlib import Path
-from random import choices
 
 import sentry_sdk
 import urllib3
 from flask import Flask
 from flask import Response
-from flask import render_template
+from flask import has_request_context
 from flask import request
 from flask.logging import default_handler
-from flask_caching import Cache
 from sentry_sdk.integrations.flask import FlaskIntegration
 
 from asim_formatter import ASIMFormatter
 from config import ValidationError
+from config import build_network_table
 from config import get_ipfilter_config
+from config import ip_in_networks
+from config import parse_ip
 from utils import constant_time_is_equal
 
 sentry_dsn = os.getenv("SENTRY_DSN")
@@ -43,37 +49,142 @@ if sentry_dsn:
 
 HTTP_METHODS = ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "HEAD"]
 
+# Proxy bodies in 256 KiB chunks: each chunk is a Python-level iteration, so
+# larger chunks mean fewer interpreter round trips per byte proxied
+STREAM_CHUNK_SIZE = 262144
+
 
 app = Flask(__name__, template_folder=Path(__file__).parent, static_folder=None)
 app.config.from_object("settings")
-cache = Cache(app)
 
 PoolClass = (
     urllib3.HTTPConnectionPool
     if app.config["SERVER_PROTO"] == "http"
     else urllib3.HTTPSConnectionPool
 )
-http = PoolClass(app.config["SERVER"], maxsize=10)
+# blocksize matches STREAM_CHUNK_SIZE so urllib3's internal buffering doesn't
+# split each streamed chunk into several smaller socket reads
+http = PoolClass(app.config["SERVER"], maxsize=10, blocksize=STREAM_CHUNK_SIZE)
+
+# Precomputed once: ADDITIONAL_IP_LIST only changes on restart. Single-host
+# entries go into a set (keyed by both the raw entry and the canonical
+# address, so non-canonical client strings still match), and only genuine
+# ranges stay in the scan table.
+_additional_strings = set(app.config["ADDITIONAL_IP_LIST"])
+_additional_addresses = set()
+_additional_networks = []
+
+for _entry in app.config["ADDITIONAL_IP_LIST"]:
+    _network = ip_network(_entry)
+
+    if _network.prefixlen == _network.max_prefixlen:
+        _additional_addresses.add((_network.version, int(_network.network_address)))
+    else:
+        _additional_networks.append(_network)
+
+additional_ip_set = frozenset(_additional_strings)
+additional_ip_addresses = frozenset(_additional_addresses)
+additional_ip_table = build_network_table(_additional_networks)
+
+
+class RequestContextQueueHandler(QueueHandler):
+    """Hand records off to the listener thread unformatted, snapshotting the
+    request object while still on the request thread so the formatter can use
+    it without a Flask request context."""
+
+    def prepare(self, record):
+        if has_request_context():
+            record.request = request._get_current_object()
+
+        return record
+
 
 logging.basicConfig(stream=sys.stdout, level=app.config["LOG_LEVEL"])
 default_handler.setFormatter(ASIMFormatter())
+
+# The ASIM formatter builds several dicts and serializes JSON per record;
+# shipping records through a queue keeps that work off the request thread.
+# queue.Queue rather than SimpleQueue so its locks are gevent-compatible.
+log_queue = queue.Queue(-1)
+log_queue_listener = QueueListener(log_queue, default_handler)
+log_queue_listener.start()
+atexit.register(log_queue_listener.stop)
+log_queue_handler = RequestContextQueueHandler(log_queue)
+
 logger = logging.getLogger(__name__)
-logger.addHandler(default_handler)
-request_id_alphabet = string.ascii_letters + string.digits
+logger.addHandler(log_queue_handler)
+app.logger.removeHandler(default_handler)
+app.logger.addHandler(log_queue_handler)
 
 urllib3_log_level = logging.getLevelName(os.getenv("URLLIB3_LOG_LEVEL", "WARN"))
 urllib3_logger = logging.getLogger("urllib3")
 urllib3_logger.setLevel(urllib3_log_level)
 urllib3_logger.removeHandler(default_handler)
 
+# The path and host lists only change on restart, so they are resolved once
+# here rather than per request.
+protected_paths = tuple(app.config["PROTECTED_PATHS"])
+public_paths = tuple(app.config["PUBLIC_PATHS"])
+
+if public_paths and protected_paths:
+    # public and protected path settings are mutually exclusive. If both are enabled, we ignore the PROTECTED_PATHS
+    # setting and emit a log message to indicate the that the IP Filter is
+    # misconfigured.
+    logger.warning(
+        "Configuration error: PROTECTED_PATHS and PUBLIC_PATHS are mutually exclusive; ignoring PROTECTED_PATHS"
+    )
+    protected_paths = ()
+
+priv_host_list = tuple(app.config["PRIV_HOST_LIST"])
+pub_host_list = tuple(app.config["PUB_HOST_LIST"])
+
+if priv_host_list and pub_host_list:
+    logger.warning(
+        "Configuration error: PRIV_HOST_LIST and PUB_HOST_LIST are mutually exclusive; ignoring PRIV_HOST_LIST"
+    )
+    priv_host_list = ()
+
+
+def _prefix_regex(paths):
+    """Compile a path list into a single prefix-matching regex, so the
+    per-request check is one C-level match instead of a startswith loop."""
+    if not paths:
+        return None
+
+    return re.compile("^(?:" + "|".join(map(re.escape, paths)) + ")")
+
+
+protected_paths_re = _prefix_regex(protected_paths)
+public_paths_re = _prefix_regex(public_paths)
+
+# LOG_LEVEL is fixed for the process lifetime, so the INFO-enabled check can
+# be done once here instead of on every per-request log call
+info_logging_enabled = logger.isEnabledFor(logging.INFO)
+
+# These settings come from the environment and cannot change while the
+# process is running, so they are bound to module-level names once instead of
+# going through app.config on every request
+ipfilter_enabled = app.config["IPFILTER_ENABLED"]
+xff_index = app.config["IP_DETERMINED_BY_X_FORWARDED_FOR_INDEX"]
+appconfig_profiles = app.config["APPCONFIG_PROFILES"]
+appconfig_ttl = app.config["APPCONFIG_TTL"]
+contact_email = app.config["EMAIL"]
+contact_email_name = app.config["EMAIL_NAME"]
+
+
+# The template never changes while the process is running, so it is compiled
+# once here and rendered directly, skipping Jinja's loader lookup and
+# auto-reload stat on every 403
+app.jinja_env.auto_reload = False
+_access_denied_template = app.jinja_env.get_template("access-denied.html")
+
 
 def render_access_denied(client_ip, forwarded_url, request_id, reason=""):
     return (
-        render_template(
-            "access-denied.html",
+        _access_denied_template.render(
             client_ip=client_ip,
-            email_name=app.config["EMAIL_NAME"],
-            email=app.config["EMAIL"],
+            email_name=contact_email_name,
+            email=contact_email,
             request_id=request_id,
             forwarded_url=forwarded_url,
         )
@@ -92,29 +203,41 @@ def render_access_denied(client_ip, forwarded_url, request_id, reason=""):
     methods=HTTP_METHODS,
 )
 def handle_request(u_path):
-    request_id = request.headers.get("X-B3-TraceId") or "".join(
-        choices(request_id_alphabet, k=8)
-    )
+    # The well-known headers below are read from the WSGI environ directly: a
+    # plain dict lookup each, with no EnvironHeaders case-insensitive scan
+    environ = request.environ
 
-    logger.info("[%s] Start", request_id)
+    # ELB health checks arrive constantly and never carry X-Forwarded-For;
+    # answering them first skips the request-id generation and logging below
+    x_forwarded_for = environ.get("HTTP_X_FORWARDED_FOR")
+
+    if x_forwarded_for is None and environ.get("HTTP_USER_AGENT", "").startswith(
+        "ELB-HealthChecker"
+    ):
+        return "OK"
+
+    request_id = environ.get("HTTP_X_B3_TRACEID") or secrets.token_urlsafe(6)
+
+    if info_logging_enabled:
+        logger.info("[%s] Start", request_id)
 
     forwarded_url = request.path
-    logger.info("[%s] Forwarded URL: %s", request_id, forwarded_url)
 
-    # Find x-forwarded-for
-    try:
-        x_forwarded_for = request.headers["X-Forwarded-For"]
-    except KeyError:
-        if request.headers.get("user-agent", "").startswith("ELB-HealthChecker"):
-            return "OK"
+    if info_logging_enabled:
+        logger.info("[%s] Forwarded URL: %s", request_id, forwarded_url)
 
+    # Find x-forwarded-for
+    if x_forwarded_for is None:
         logger.error("[%s] X-Forwarded-For header is missing", request_id)
         return render_access_denied("Unknown", forwarded_url, request_id)
 
     try:
-        client_ip = x_forwarded_for.split(",")[
-            app.config["IP_DETERMINED_BY_X_FORWARDED_FOR_INDEX"]
-        ].strip()
+        # For the usual negative index, rsplit only performs as many splits
+        # as needed to reach the element, however long the forwarding chain
+        if xff_index < 0:
+            client_ip = x_forwarded_for.rsplit(",", -xff_index)[xff_index].strip()
+        else:
+            client_ip = x_forwarded_for.split(",", xff_index + 1)[xff_index].strip()
     except IndexError:
         logger.error(
             "[%s] Not enough addresses in x-forwarded-for %s",
@@ -123,59 +246,33 @@ def handle_request(u_path):
         )
         return render_access_denied("Unknown", forwarded_url, request_id)
 
-    protected_paths = app.config["PROTECTED_PATHS"]
-    public_paths = app.config["PUBLIC_PATHS"]
-
-    if public_paths and protected_paths:
-        # public and protected path settings are mutually exclusive. If both are enabled, we ignore the PROTECTED_PATHS
-        # setting and emit a log message to indicate the that the IP Filter is
-        # misconfigured.
-        logger.warning(
-            "Configuration error: PROTECTED_PATHS and PUBLIC_PATHS are mutually exclusive; ignoring PROTECTED_PATHS"
-        )
-        protected_paths = []
-
-    priv_host_list = app.config["PRIV_HOST_LIST"]
-    pub_host_list = app.config["PUB_HOST_LIST"]
+    ip_filter_enabled_and_required_for_path = ipfilter_enabled
 
-    if priv_host_list and pub_host_list:
-        logger.warning(
-            "Configuration error: PRIV_HOST_LIST and PUB_HOST_LIST are mutually exclusive; ignoring PRIV_HOST_LIST"
-        )
-        priv_host_list = []
-
-    ip_filter_enabled_and_required_for_path = app.config["IPFILTER_ENABLED"]
+    # Matched once here and reused by every decision point below
+    on_protected_path = bool(
+        protected_paths_re and protected_paths_re.match(request.path)
+    )
+    on_public_path = bool(public_paths_re and public_paths_re.match(request.path))
 
     # Paths are public by default unless listed in the PROTECTED_PATHS env var
-    if bool(protected_paths) and not any(
-        request.path.startswith(path) for path in protected_paths
-    ):
+    if bool(protected_paths) and not on_protected_path:
         ip_filter_enabled_and_required_for_path = False
 
     # Paths are protected by default unless listed in the PUBLIC_PATHS env var
-    if bool(public_paths) and any(
-        request.path.startswith(path) for path in public_paths
-    ):
+    if on_public_path:
         ip_filter_enabled_and_required_for_path = False
 
     if bool(priv_host_list) and request.host not in priv_host_list:
         ip_filter_enabled_and_required_for_path = False
 
-    if (
-        bool(pub_host_list)
-        and request.host in pub_host_list
-        and (
-            not bool(protected_paths)
-            or not any(request.path.startswith(path) for path in protected_paths)
-        )
-    ):
+    if bool(pub_host_list) and request.host in pub_host_list and not on_protected_path:
         ip_filter_enabled_and_required_for_path = False
 
-    headers_to_remove = []
+    headers_to_remove = frozenset()
 
     if ip_filter_enabled_and_required_for_path:
         try:
-            ip_filter_rules = get_ipfilter_config(app.config["APPCONFIG_PROFILES"])
+            ip_filter_rules = get_ipfilter_config(appconfig_profiles, ttl=appconfig_ttl)
         except ValidationError as ex:
             logger.error(f"[%s] {ex}", request_id)
             return render_access_denied(client_ip, forwarded_url, request_id)
@@ -183,74 +280,85 @@ def handle_request(u_path):
             logger.error(f"[%s] {ex}", request_id)
             return render_access_denied(client_ip, forwarded_url, request_id, str(ex))
 
-        additional_ip_list = app.config["ADDITIONAL_IP_LIST"]
-        ip_in_whitelist = (
-            any(
-                ip_address(client_ip) in ip_network(ip_range)
-                for ip_range in ip_filter_rules["ips"]
-            )
-            or client_ip in additional_ip_list
-            or any(
-                ip_address(client_ip) in ip_network(ip_range)
-                for ip_range in additional_ip_list
+        ip_in_whitelist = client_ip in additional_ip_set
+
+        if not ip_in_whitelist:
+            # Parsed at most once per request, and only when the O(1) exact
+            # match above missed
+            parsed_client_ip = parse_ip(client_ip)
+
+            ip_in_whitelist = parsed_client_ip is not None and (
+                parsed_client_ip in additional_ip_addresses
+                or ip_in_networks(*parsed_client_ip, ip_filter_rules["network_table"])
+                or ip_in_networks(*parsed_client_ip, additional_ip_table)
             )
-        )
 
         shared_tokens = ip_filter_rules["shared_tokens"]
-        shared_token_ok = [
-            shared_token["HeaderName"] in request.headers
-            and constant_time_is_equal(
-                shared_token["Value"].encode(),
-                request.headers[shared_token["HeaderName"]].encode(),
-            )
-            for shared_token in shared_tokens
-        ]
 
-        def verify_credentials(app_auth: dict) -> bool:
+        # Configured credentials are stored as SHA-256 digests, so the
+        # client-supplied values are hashed once here and every comparison is
+        # over fixed-length digests. Non-Basic Authorization headers (e.g.
+        # Bearer tokens) still parse into an object, but with username and
+        # password of None; they count as no basic credentials supplied
+        authorization = request.authorization
+        has_basic_credentials = (
+            authorization is not None
+            and authorization.username is not None
+            and authorization.password is not None
+        )
+        if has_basic_credentials:
+            request_username_digest = sha256(authorization.username.encode()).digest()
+            request_password_digest = sha256(authorization.password.encode()).digest()
+
+        def verify_credentials(username_digest: bytes, password_digest: bytes) -> bool:
             return (
-                request.authorization
-                and constant_time_is_equal(
-                    app_auth["Username"].encode(),
-                    request.authorization.username.encode(),
-                )
-                and constant_time_is_equal(
-                    app_auth["Password"].encode(),
-                    request.authorization.password.encode(),
-                )
+                has_basic_credentials
+                and constant_time_is_equal(username_digest, request_username_digest)
+                and constant_time_is_equal(password_digest, request_password_digest)
             )
 
         # TODO: reintroduce shared token check
 
-        basic_auths = ip_filter_rules["auth"]
-        basic_auths_ok = [verify_credentials(auth) for auth in basic_auths]
+        auth_index = ip_filter_rules["auth_index"]
 
-        # Add boolean values from basic_auths_ok to new list, if basic auth path matches current request path
-        on_auth_path_and_ok = []
-        for i, basic_auth_ok in enumerate(basic_auths_ok):
-            if basic_auths[i]["Path"] == forwarded_url:
-                on_auth_path_and_ok.append(basic_auth_ok)
+        # One dict probe finds the entry for this path and username rather
+        # than scanning every configured entry; the password stays a
+        # constant-time comparison. Whether the path has any entries at all
+        # (which decides the 401 challenge below) is a separate set lookup.
+        any_on_auth_path_and_ok = False
+        if has_basic_credentials:
+            expected_password_digests = auth_index.get(
+                (forwarded_url, request_username_digest), ()
+            )
+            any_on_auth_path_and_ok = any(
+                constant_time_is_equal(expected_digest, request_password_digest)
+                for expected_digest in expected_password_digests
+            )
 
-        any_on_auth_path_and_ok = any(on_auth_path_and_ok)
+        auth_on_request_path = forwarded_url in ip_filter_rules["auth_paths"]
 
-        headers_to_remove = tuple(
-            set(shared_token["HeaderName"].lower() for shared_token in shared_tokens)
-        ) + ("connection",)
+        headers_to_remove = ip_filter_rules["headers_to_remove"]
 
-        shared_token_checks_passed = not shared_tokens or any(shared_token_ok)
+        # Lazy generator so token comparison stops at the first match
+        shared_token_checks_passed = not shared_tokens or any(
+            header_name in request.headers
+            and constant_time_is_equal(
+                value_digest,
+                sha256(request.headers[header_name].encode()).digest(),
+            )
+            for header_name, value_digest in ip_filter_rules["shared_token_checks"]
+        )
 
         # Valid basic auth username and password were supplied, but basic auth path doesn't match request url
-        should_request_auth = not any_on_auth_path_and_ok and (
-            ip_in_whitelist
+        should_request_auth = (
+            not any_on_auth_path_and_ok
+            and ip_in_whitelist
             and shared_token_checks_passed
-            and len(on_auth_path_and_ok)
-            and all(not ok for ok in on_auth_path_and_ok)
+            and auth_on_request_path
         )
 
         should_respond_ok_to_auth_request = (
-            any_on_auth_path_and_ok
-            and ip_in_whitelist
-            and shared_token_checks_passed
-            and len(on_auth_path_and_ok)
+            any_on_auth_path_and_ok and ip_in_whitelist and shared_token_checks_passed
         )
 
         if should_request_auth:
@@ -264,7 +372,18 @@ def handle_request(u_path):
         if should_respond_ok_to_auth_request:
             return "ok"
 
-        basic_auth_checks_passed = not any(basic_auths) or any(basic_auths_ok)
+        basic_auth_checks_passed = (
+            not auth_index
+            or any_on_auth_path_and_ok
+            or any(
+                path != forwarded_url
+                and any(
+                    verify_credentials(username_digest, password_digest)
+                    for password_digest in password_digests
+                )
+                for (path, username_digest), password_digests in auth_index.items()
+            )
+        )
 
         all_checks_passed = (
             ip_in_whitelist and shared_token_checks_passed and basic_auth_checks_passed
@@ -274,7 +393,8 @@ def handle_request(u_path):
             logger.warning("[%s] Request blocked for %s", request_id, client_ip)
             return render_access_denied(client_ip, forwarded_url, request_id)
 
-    logger.info("[%s] Making request to origin", request_id)
+    if info_logging_enabled:
+        logger.info("[%s] Making request to origin", request_id)
 
     # We proxy request data via an iterable, but only if we need to. This avoids turning GET
     # requests without bodies into "transfer-encoding: chunked" requests, which can cause certain
@@ -284,9 +404,9 @@ def handle_request(u_path):
         "content-length" in request.headers
         or request.headers.get("transfer-encoding", "").lower() == "chunked"
     )
-    request_body = (
-        iter(lambda: request.stream.read(65536), b"") if has_request_body else None
-    )
+    # urllib3 accepts a file-like body directly and reads it into its socket
+    # buffer itself, so there is no Python-level generator frame per chunk
+    request_body = request.stream if has_request_body else None
 
     origin_response = http.request(
         request.method,
@@ -300,32 +420,39 @@ def handle_request(u_path):
         retries=False,
         body=request_body,
     )
-    logger.info("[%s] Origin response status: %s", request_id, origin_response.status)
+    if info_logging_enabled:
+        logger.info(
+            "[%s] Origin response status: %s", request_id, origin_response.status
+        )
 
     def release_conn():
         origin_response.close()
         origin_response.release_conn()
-        logger.info("[%s] End", request_id)
+        if info_logging_enabled:
+            logger.info("[%s] End", request_id)
+
+    # HTTPHeaderDict.discard is case-insensitive, so this avoids lowercasing
+    # every header name just to drop the connection header
+    response_headers = origin_response.headers.copy()
+    response_headers.discard("Connection")
 
     downstream_response = Response(
-        origin_response.stream(65536, decode_content=False),
+        origin_response.stream(STREAM_CHUNK_SIZE, decode_content=False),
         status=origin_response.status,
-        headers=[
-            (k, v)
-            for k, v in origin_response.headers.items()
-            if k.lower() != "connection"
-        ],
+        headers=list(response_headers.items()),
     )
     downstream_response.autocorrect_location_header = False
     downstream_response.call_on_close(release_conn)
 
-    logger.info("[%s] Starting response to client", request_id)
+    if info_logging_enabled:
+        logger.info("[%s] Starting response to client", request_id)
 
     return downstream_response
 
 
 @app.after_request
 def log_response(response):
-    app.logger.info("Response details", extra={"response": response})
+    if info_logging_enabled:
+        app.logger.info("Response details", extra={"response": response})
 
     return response
@@ -11,9 +11,6 @@ LOG_LEVEL = env.get("LOG_LEVEL", "INFO")
 logging.basicConfig(stream=sys.stdout, level=LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
-# Flask-Caching related configs
-CACHE_TYPE = "SimpleCache"
-CACHE_DEFAULT_TIMEOUT = 300
 DEBUG = env.bool("DEBUG", default=False)
 ENVIRONMENT_NAME = env["COPILOT_ENVIRONMENT_NAME"]
 
@@ -21,6 +18,7 @@ SERVER_PROTO = env.get("SERVER_PROTO", "http")
 SERVER = env["SERVER"]
 
 APPCONFIG_URL = env.get("APPCONFIG_URL", "http://localhost:2772")
+APPCONFIG_TTL = env.int("APPCONFIG_TTL", default=30)
 
 EMAIL_NAME = env.get("EMAIL_NAME", "DBT")
 EMAIL = env["EMAIL"]
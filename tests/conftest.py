@@ -1,55 +1,143 @@
+import functools
 import gzip
 import os
+import shlex
 import signal
 import socket
+import string
 import subprocess
 import sys
+import tempfile
 import time
-import urllib
 from io import BytesIO
 
+import multiprocess
+import urllib3
 from flask import Flask
 from flask import Response
 from flask import abort
 from flask import request
 from multiprocess import Process
 from werkzeug.routing import Rule
+from werkzeug.serving import BaseWSGIServer
 from werkzeug.serving import WSGIRequestHandler
 
+# fork is the cheapest start method for the origin/appconfig helpers: the
+# children inherit this process's already-imported Flask and werkzeug rather
+# than re-importing them (spawn, the default on macOS, re-imports everything)
+if multiprocess.get_start_method(allow_none=True) != "fork":
+    multiprocess.set_start_method("fork", force=True)
+
+
+# The test servers bind fixed ports back to back, so SO_REUSEPORT (where
+# available) stops a bind racing the previous process's not-quite-closed
+# listen socket. SO_LINGER(0) was considered too, but resetting connections
+# on close risks truncating responses the client hasn't read yet.
+_original_server_bind = BaseWSGIServer.server_bind
+
+
+def _reuseport_server_bind(self):
+    if hasattr(socket, "SO_REUSEPORT"):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    return _original_server_bind(self)
+
+
+BaseWSGIServer.server_bind = _reuseport_server_bind
 
-def create_filter(port, env=()):
-    def stop():
-        process.terminate()
-        process.wait()
 
+def _web_command():
     with open("Procfile", "r") as f:
-        lines = f.readlines()
-    for line in lines:
-        name, _, command = line.partition(":")
-        if name.strip() == "web":
-            break
+        for line in f:
+            name, _, command = line.partition(":")
+            if name.strip() == "web":
+                return command.strip()
 
-    default_env = {
+
+# The Procfile cannot change mid-run, so it is parsed once rather than once
+# per create_filter call
+_WEB_COMMAND = _web_command()
+
+
+# One keep-alive pool shared by the tests instead of a PoolManager (and its
+# TCP handshake) per request. create_filter clears it on teardown so
+# gunicorn's graceful shutdown isn't held up by idle sockets.
+http_pool = urllib3.PoolManager(num_pools=4, maxsize=16)
+
+
+# os.environ and the defaults don't change between tests, so the merged base
+# is built once instead of copying every inherited variable per create_filter
+# call
+_FILTER_BASE_ENV = {
+    **os.environ,
+    "EMAIL_NAME": "The Department for International Trade WebOps team",
+    "EMAIL": "test@test.test",
+    "LOG_LEVEL": "DEBUG",
+    "DEBUG": "True",
+}
+
+
+def create_filter(port, env=()):
+    process_env = {
+        **_FILTER_BASE_ENV,
         "PORT": str(port),
-        "EMAIL_NAME": "The Department for International Trade WebOps team",
-        "EMAIL": "test@test.test",
-        "LOG_LEVEL": "DEBUG",
-        "DEBUG": "True",
+        **dict(env),
     }
 
-    process = subprocess.Popen(
-        ["bash", "-c", command.strip()],
-        env={
-            **os.environ,
-            **default_env,
-            **dict(env),
-        },
-    )
+    # Exec the Procfile command directly rather than via `bash -c`, expanding
+    # any $VAR references against the child's environment ourselves. This
+    # saves a shell fork+exec per test while still running the filter under
+    # gunicorn exactly as deployed.
+    args = [
+        string.Template(arg).safe_substitute(process_env)
+        for arg in shlex.split(_WEB_COMMAND)
+    ]
+
+    # posix_spawnp avoids forking (and copying the page tables of) the whole
+    # test-runner process just to exec gunicorn
+    pid = os.posix_spawnp(args[0], args, process_env)
+
+    def stop():
+        http_pool.clear()
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
 
     return stop
 
 
-def create_origin(port):
+# Self-signed certificate (CN/SAN localhost) used when the origin serves TLS,
+# so the https tests don't depend on an external site. Generated fresh into a
+# temporary directory each session rather than checked in, so no private key
+# lives in the repository (the detect-private-key pre-commit hook would
+# rightly reject one).
+_tls_dir = tempfile.mkdtemp(prefix="ip-filter-tls-")
+TLS_CERTIFICATE = os.path.join(_tls_dir, "localhost-cert.pem")
+TLS_PRIVATE_KEY = os.path.join(_tls_dir, "localhost-key.pem")
+
+subprocess.run(
+    [
+        "openssl",
+        "req",
+        "-x509",
+        "-newkey",
+        "rsa:2048",
+        "-nodes",
+        "-keyout",
+        TLS_PRIVATE_KEY,
+        "-out",
+        TLS_CERTIFICATE,
+        "-days",
+        "1",
+        "-subj",
+        "/CN=localhost",
+        "-addext",
+        "subjectAltName=DNS:localhost",
+    ],
+    check=True,
+    capture_output=True,
+)
+
+
+def create_origin(port, tls=False):
     def start():
         # Avoid warning about this not a prod server
         os.environ["FLASK_ENV"] = "development"
@@ -77,18 +165,28 @@ def create_origin(port):
         WSGIRequestHandler.protocol_version = "HTTP/1.1"
 
         try:
-            origin_app.run(host="", port=port, debug=False)
+            origin_app.run(
+                host="",
+                port=port,
+                debug=False,
+                ssl_context=(TLS_CERTIFICATE, TLS_PRIVATE_KEY) if tls else None,
+            )
         except SystemExit:
             # origin_app.run doesn't seem to have a good way of killing the
             # server, and need to exit cleanly for code coverage to be saved
             pass
 
+    # bytes objects are immutable and written straight to the socket, so one
+    # buffer per size can be shared across requests
+    @functools.lru_cache(maxsize=8)
+    def chunked_payload(num_bytes):
+        return b"-" * num_bytes
+
     def chunked():
         num_bytes = int(request.headers["x-chunked-num-bytes"])
 
         def data():
-            chunk = b"-" * num_bytes
-            yield chunk
+            yield chunked_payload(num_bytes)
 
         # transfer-encoding: chunked is set by the Flask server
         return Response(
@@ -104,8 +202,16 @@ def create_origin(port):
 
     def gzipped():
         gzip_buffer = BytesIO()
-        gzip_file = gzip.GzipFile(mode="wb", compresslevel=9, fileobj=gzip_buffer)
-        gzip_file.write(request.stream.read())
+        # Level 1 is much cheaper than 9 and the tests only assert on the
+        # decoded bytes, never the compressed size
+        gzip_file = gzip.GzipFile(mode="wb", compresslevel=1, fileobj=gzip_buffer)
+        # Compress in blocks rather than materialising the whole request
+        # body in memory first
+        while True:
+            chunk = request.stream.read(65536)
+            if not chunk:
+                break
+            gzip_file.write(chunk)
         gzip_file.close()
         zipped = gzip_buffer.getvalue()
 
@@ -123,23 +229,28 @@ def create_origin(port):
         # have no response body
 
         def _extract_path(url):
-            parts = urllib.parse.urlparse(url)
-            return parts.path + "?" + parts.query
+            # RAW_URI is always in origin-form here, so a partition on "?"
+            # replaces a full urlparse
+            path, _, query = url.partition("?")
+            return path + "?" + query
 
         response_header_prefix = "x-echo-response-header-"
-        headers = (
-            [
-                ("x-echo-method", request.method),
-                ("x-echo-raw-uri", _extract_path(request.environ["RAW_URI"])),
-                ("x-echo-remote-port", request.environ["REMOTE_PORT"]),
-            ]
-            + [("x-echo-header-" + k, v) for k, v in request.headers.items()]
-            + [
-                (k[len(response_header_prefix) :], v)
-                for k, v in request.headers.items()
-                if k.lower().startswith(response_header_prefix)
-            ]
-        )
+        headers = [
+            ("x-echo-method", request.method),
+            ("x-echo-raw-uri", _extract_path(request.environ["RAW_URI"])),
+            ("x-echo-remote-port", request.environ["REMOTE_PORT"]),
+        ]
+        # One pass over the headers builds both the echoed and the
+        # response-prefixed lists; the latter is appended afterwards to keep
+        # the original ordering
+        response_headers = []
+        for k, v in request.headers.items():
+            headers.append(("x-echo-header-" + k, v))
+            # The first-character test skips the lowercased-copy allocation
+            # for the vast majority of headers that can't match the prefix
+            if k[0] in "xX" and k.lower().startswith(response_header_prefix):
+                response_headers.append((k[len(response_header_prefix) :], v))
+        headers += response_headers
 
         return Response(
             request.stream.read(),
@@ -148,7 +259,12 @@ def create_origin(port):
         )
 
     def stop():
-        process.terminate()
+        # SIGKILL makes teardown instant; SIGTERM is only needed when the
+        # child must run its exit handlers to save coverage data
+        if "COVERAGE_PROCESS_START" in os.environ:
+            process.terminate()
+        else:
+            process.kill()
         process.join()
 
     process = Process(target=start)
@@ -158,6 +274,10 @@ def create_origin(port):
 
 
 def wait_until_connectable(port, max_attempts=1000):
+    # The first probe happens immediately and the sleep between failures
+    # grows geometrically, so a server that is already up costs ~0 wait while
+    # a slow start still gets a generous total timeout
+    delay = 0.0005
     for i in range(0, max_attempts):
         try:
             with socket.create_connection(("127.0.0.1", port), timeout=0.1):
@@ -165,7 +285,31 @@ def wait_until_connectable(port, max_attempts=1000):
         except (OSError, ConnectionRefusedError):
             if i == max_attempts - 1:
                 raise
-            time.sleep(0.01)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.02)
+
+
+def wait_until_connectable_many(ports, max_attempts=1000):
+    """Wait for several ports in one backoff loop, so the total wait tracks
+    the slowest server's start-up rather than the sum of all of them."""
+    remaining = set(ports)
+    delay = 0.0005
+    for i in range(0, max_attempts):
+        for port in sorted(remaining):
+            try:
+                with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                    remaining.discard(port)
+            except (OSError, ConnectionRefusedError):
+                pass
+
+        if not remaining:
+            return
+
+        if i == max_attempts - 1:
+            raise OSError(f"Ports never became connectable: {sorted(remaining)}")
+
+        time.sleep(delay)
+        delay = min(delay * 2, 0.02)
 
 
 def create_appconfig_agent(port, config_map=None, override_config=False):
@@ -223,7 +367,12 @@ BasicAuth: []
         )
 
     def stop():
-        process.terminate()
+        # SIGKILL makes teardown instant; SIGTERM is only needed when the
+        # child must run its exit handlers to save coverage data
+        if "COVERAGE_PROCESS_START" in os.environ:
+            process.terminate()
+        else:
+            process.kill()
         process.join()
 
     process = Process(target=start)
@@ -1,10 +1,12 @@
 import unittest
+from hashlib import sha256
+from ipaddress import ip_network
 from unittest.mock import patch
 
+import pytest
 import urllib3
-from parameterized import parameterized
 
-from config import Environ, get_ipfilter_config, ValidationError
+from config import Environ, HOP_BY_HOP_HEADERS, build_network_table, clear_ipfilter_config_cache, get_ipfilter_config, ip_in_networks, parse_ip, ValidationError
 from tests.conftest import create_filter, create_origin, wait_until_connectable, create_appconfig_agent
 
 BAD_APP_CONFIG = """
@@ -21,13 +23,13 @@ IpRanges:
     - 1.1.1.1/32
 """
 
+# Every Environ in these tests starts from the same deployment name; the
+# shared mapping is merged rather than re-typed per test
+BASE_ENV = {"COPILOT_ENVIRONMENT_NAME": "staging"}
+
 class EnvironTestCase(unittest.TestCase):
     def test_missing_key_raises_keyerror(self):
-        env = Environ(
-            {
-                "COPILOT_ENVIRONMENT_NAME": "staging",
-            }
-        )
+        env = Environ(dict(BASE_ENV))
 
         with self.assertRaises(KeyError):
             env.get_value("MISSING")
@@ -42,11 +44,7 @@ class EnvironTestCase(unittest.TestCase):
             env.int("MISSING")
 
     def test_default_values(self):
-        env = Environ(
-            {
-                "COPILOT_ENVIRONMENT_NAME": "staging",
-            }
-        )
+        env = Environ(dict(BASE_ENV))
 
         self.assertEqual(env.get_value("MISSING", default="missing"), "missing")
         self.assertEqual(env.bool("MISSING", default=True), True)
@@ -57,7 +55,7 @@ class EnvironTestCase(unittest.TestCase):
     def test_type_conversion_bool(self):
         env = Environ(
             {
-                "COPILOT_ENVIRONMENT_NAME": "staging",
+                **BASE_ENV,
                 "IS_TRUE": "True",
                 "IS_FALSE": "False",
             }
@@ -69,7 +67,7 @@ class EnvironTestCase(unittest.TestCase):
     def test_type_conversion_list(self):
         env = Environ(
             {
-                "COPILOT_ENVIRONMENT_NAME": "staging",
+                **BASE_ENV,
                 "MULTIPLE": "profile1, profile2, profile3",
                 "SINGLE_ITEM": "False",
                 "EMPTY": "",
@@ -82,7 +80,7 @@ class EnvironTestCase(unittest.TestCase):
     def test_type_conversion_int(self):
         env = Environ(
             {
-                "COPILOT_ENVIRONMENT_NAME": "staging",
+                **BASE_ENV,
                 "TEST": "-1",
             }
         )
@@ -91,7 +89,7 @@ class EnvironTestCase(unittest.TestCase):
     def test_type_with_environment_overrides(self):
         env = Environ(
             {
-                "COPILOT_ENVIRONMENT_NAME": "staging",
+                **BASE_ENV,
                 "RANDOM_FIELD": "base-value",
                 "STAGING_RANDOM_FIELD": "environment-override",
             }
@@ -114,7 +112,7 @@ class EnvironTestCase(unittest.TestCase):
         """
         env = Environ(
             {
-                "COPILOT_ENVIRONMENT_NAME": "staging",
+                **BASE_ENV,
                 "PROTECTED_PATHS": "one,two,three",
                 "STAGING_PROTECTED_PATHS": "",
             }
@@ -129,9 +127,21 @@ class EnvironTestCase(unittest.TestCase):
         )
 
 
+@pytest.mark.integration
 class ConfigurationTestCase(unittest.TestCase):
     """Tests covering the configuration logic."""
 
+    # The origin is stateless, so one instance is shared across the whole
+    # class rather than paying a process start per test
+    @classmethod
+    def setUpClass(cls):
+        cls.stop_origin = create_origin(8081)
+        wait_until_connectable(8081)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stop_origin()
+
     def _setup_environment(
             self,
             env=(),
@@ -141,20 +151,24 @@ class ConfigurationTestCase(unittest.TestCase):
             ("SERVER_PROTO", "http"),
         )
         self.addCleanup(create_filter(8080, default_env + env))
-        self.addCleanup(create_origin(8081))
+        # Run before the filter is stopped (cleanups run last-in-first-out),
+        # so gunicorn isn't left waiting on idle keep-alive connections
+        self.addCleanup(self.http.clear)
         wait_until_connectable(8080)
-        wait_until_connectable(8081)
+
+    # Shared so the requests a test makes can reuse a connection instead of
+    # paying a fresh PoolManager and TCP connect per call
+    http = urllib3.PoolManager(maxsize=4)
+
+    _BASE_HEADERS = {
+        "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
+    }
 
     def _make_request(self, request_path="/", additional_headers={}):
-        headers = {
-                "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                "connection": "close",
-            }
-        headers.update(additional_headers)
-        response = urllib3.PoolManager().request(
+        response = self.http.request(
             "GET",
             url=f"http://127.0.0.1:8080{request_path}",
-            headers=headers,
+            headers={**self._BASE_HEADERS, **additional_headers},
             body=b"some-data",
         )
 
@@ -342,36 +356,121 @@ class ConfigurationTestCase(unittest.TestCase):
         self.assertEqual(response.status, 403)
 
 
+_GOOD_CONFIG_TEMPLATE = {
+    "IpRanges": ["1.1.1.1/32", "2.2.2.2", "2001:db8:abcd:0012::0/64"],
+    "BasicAuth": [
+        {
+            "Path": "/__some_path",
+            "Username": "my-user",
+            "Password": "my-secret"
+        }
+    ],
+    "SharedTokens": [
+        {
+            "HeaderName": "x-cdn-secret",
+            "Value": "my-secret"
+        },
+    ]
+}
+
+
 def good_config():
+    # The nested containers are copied too, as the validation tests mutate
+    # them in place
     return {
-        "IpRanges": ["1.1.1.1/32", "2.2.2.2", "2001:db8:abcd:0012::0/64"],
-        "BasicAuth": [
-            {
-                "Path": "/__some_path",
-                "Username": "my-user",
-                "Password": "my-secret"
-            }
-        ],
-        "SharedTokens": [
-            {
-                "HeaderName": "x-cdn-secret",
-                "Value": "my-secret"
-            },
-        ]
+        "IpRanges": list(_GOOD_CONFIG_TEMPLATE["IpRanges"]),
+        "BasicAuth": [entry.copy() for entry in _GOOD_CONFIG_TEMPLATE["BasicAuth"]],
+        "SharedTokens": [entry.copy() for entry in _GOOD_CONFIG_TEMPLATE["SharedTokens"]],
     }
 
 
-@patch("config.get_appconfig_configuration")
+class NetworkTableTestCase(unittest.TestCase):
+    def test_parse_ip(self):
+        self.assertEqual(parse_ip("1.2.3.4"), (4, 0x01020304))
+        self.assertEqual(parse_ip("::1"), (6, 1))
+        self.assertIsNone(parse_ip("not-an-ip"))
+        self.assertIsNone(parse_ip("1.2.3.4.5"))
+        self.assertIsNone(parse_ip(""))
+
+    def test_ip_in_networks_matches_like_ip_network_containment(self):
+        table = build_network_table(
+            ip_network(ip)
+            for ip in ["1.1.1.1/32", "3.3.3.0/24", "2001:db8:abcd:0012::0/64"]
+        )
+
+        self.assertTrue(ip_in_networks(*parse_ip("1.1.1.1"), table))
+        self.assertTrue(ip_in_networks(*parse_ip("3.3.3.42"), table))
+        self.assertTrue(ip_in_networks(*parse_ip("2001:db8:abcd:12::1"), table))
+        self.assertFalse(ip_in_networks(*parse_ip("1.1.1.2"), table))
+        self.assertFalse(ip_in_networks(*parse_ip("3.3.4.1"), table))
+        self.assertFalse(ip_in_networks(*parse_ip("2001:db8:abcd:13::1"), table))
+        # A v4 address never matches a v6 network of the same integer value
+        self.assertFalse(ip_in_networks(*parse_ip("3.3.3.42"), build_network_table([ip_network("::/0")])))
+
+
 class AppConfigValidationTestCase(unittest.TestCase):
-    def test_get_ipfilter_config_success(self, appconfig):
+    # Patched once for the whole class: entering and exiting the mock
+    # machinery per test was most of these tests' runtime
+    @classmethod
+    def setUpClass(cls):
+        cls._appconfig_patcher = patch("config.get_appconfig_configuration")
+        cls.appconfig = cls._appconfig_patcher.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._appconfig_patcher.stop()
+
+    def setUp(self):
+        clear_ipfilter_config_cache()
+        self.appconfig.reset_mock(return_value=True, side_effect=True)
+
+    def test_get_ipfilter_config_success(self):
         config = good_config()
-        appconfig.return_value = config
+        self.appconfig.return_value = config
 
         actual = get_ipfilter_config(["a"])
 
-        self.assertEqual(actual, {"ips": config["IpRanges"], "auth": config["BasicAuth"], "shared_tokens": config["SharedTokens"]})
+        self.assertEqual(actual["ips"], config["IpRanges"])
+        self.assertEqual(actual["auth"], config["BasicAuth"])
+        self.assertEqual(actual["shared_tokens"], config["SharedTokens"])
+        self.assertEqual(
+            actual["network_table"],
+            build_network_table(ip_network(ip) for ip in config["IpRanges"]),
+        )
+        self.assertEqual(
+            actual["headers_to_remove"],
+            HOP_BY_HOP_HEADERS | frozenset(["x-cdn-secret"]),
+        )
+        self.assertEqual(
+            actual["shared_token_checks"],
+            (("x-cdn-secret", sha256(b"my-secret").digest()),),
+        )
+        self.assertEqual(
+            actual["auth_index"],
+            {
+                ("/__some_path", sha256(b"my-user").digest()): (
+                    sha256(b"my-secret").digest(),
+                )
+            },
+        )
+        self.assertEqual(actual["auth_paths"], frozenset(["/__some_path"]))
+
+    def test_get_ipfilter_config_is_cached_until_ttl_expires(self):
+        self.appconfig.return_value = good_config()
+
+        first = get_ipfilter_config(["a"])
+        second = get_ipfilter_config(["a"])
+
+        self.assertIs(first, second)
+        self.assertEqual(self.appconfig.call_count, 1)
 
-    def test_get_ipfilter_config_multiple_paths_aggregate_results(self, appconfig):
+        # A TTL of zero has always expired, so the config is refetched
+        clear_ipfilter_config_cache()
+        get_ipfilter_config(["a"], ttl=0)
+        get_ipfilter_config(["a"], ttl=0)
+        self.assertEqual(self.appconfig.call_count, 3)
+
+    def test_get_ipfilter_config_multiple_paths_aggregate_results(self):
         config_a = good_config()
         config_b = {"IpRanges": ["3.3.3.0/24"]}
         config_c = {"BasicAuth": [
@@ -387,7 +486,7 @@ class AppConfigValidationTestCase(unittest.TestCase):
                 "Value": "my-other-secret"
             }
         ]}
-        appconfig.side_effect = lambda path: {"a": config_a, "b": config_b, "c": config_c, "d": config_d}[path]
+        self.appconfig.side_effect = lambda path: {"a": config_a, "b": config_b, "c": config_c, "d": config_d}[path]
 
         actual = get_ipfilter_config(["a", "b", "c", "d"])
 
@@ -395,44 +494,87 @@ class AppConfigValidationTestCase(unittest.TestCase):
         self.assertEqual(actual["auth"], [config_a["BasicAuth"][0], config_c["BasicAuth"][0]])
         self.assertEqual(actual["shared_tokens"], [config_a["SharedTokens"][0], config_d["SharedTokens"][0]])
 
-    def test_get_ipfilter_config_ignores_additional_keys(self, appconfig):
+    def test_get_ipfilter_config_ignores_additional_keys(self):
         config = good_config()
         config["BOGUS"] = True
         config["SAMOSA"] = "Mmm"
-        appconfig.return_value = config
+        self.appconfig.return_value = config
 
         actual = get_ipfilter_config(["a"])
-        self.assertEqual(actual, {"ips": config["IpRanges"], "auth": config["BasicAuth"], "shared_tokens": config["SharedTokens"]})
 
-    def test_get_ipfilter_config_all_keys_optional(self, appconfig):
+        self.assertEqual(actual["ips"], config["IpRanges"])
+        self.assertEqual(actual["auth"], config["BasicAuth"])
+        self.assertEqual(actual["shared_tokens"], config["SharedTokens"])
+        self.assertEqual(
+            actual["network_table"],
+            build_network_table(ip_network(ip) for ip in config["IpRanges"]),
+        )
+        self.assertEqual(
+            actual["headers_to_remove"],
+            HOP_BY_HOP_HEADERS | frozenset(["x-cdn-secret"]),
+        )
+        self.assertEqual(
+            actual["shared_token_checks"],
+            (("x-cdn-secret", sha256(b"my-secret").digest()),),
+        )
+        self.assertEqual(
+            actual["auth_index"],
+            {
+                ("/__some_path", sha256(b"my-user").digest()): (
+                    sha256(b"my-secret").digest(),
+                )
+            },
+        )
+        self.assertEqual(actual["auth_paths"], frozenset(["/__some_path"]))
+
+    def test_get_ipfilter_config_all_keys_optional(self):
         config = {}
-        appconfig.return_value = config
+        self.appconfig.return_value = config
 
         actual = get_ipfilter_config(["a"])
-        self.assertEqual(actual, {"ips": [], "auth": [], "shared_tokens": []})
+        self.assertEqual(
+            actual,
+            {
+                "ips": [],
+                "network_table": (),
+                "auth": [],
+                "shared_tokens": [],
+                "headers_to_remove": HOP_BY_HOP_HEADERS,
+                "shared_token_checks": (),
+                "auth_index": {},
+                "auth_paths": frozenset(),
+            },
+        )
 
-    @parameterized.expand(
-        [
+    # These cases run as subTests within one test method rather than via
+    # parameterized.expand, so the per-test collection and setup cost is paid
+    # once per group instead of once per case
+    def test_get_ipfilter_config_bad_ip_range_raises_exception(self):
+        cases = [
             ("not-an-ip-range", "does not appear to be an IPv4 or IPv6 network"),
             ("1.1.1.1/16", "has host bits set"),
             ("2001:db8:abcd:12:bad::/32", "has host bits set"),
         ]
-    )
-    def test_get_ipfilter_config_bad_ip_range_raises_exception(self, appconfig, ip_range, exp_error):
-        conf = good_config()
-        conf["IpRanges"].append(ip_range)
-        appconfig.return_value = conf
-
-        try:
-            get_ipfilter_config(["a"])
-            self.fail("Validation should have failed")
-        except ValidationError as ex:
-            self.assertTrue("Key 'IpRanges'" in str(ex))
-            self.assertTrue(f"ip_network('{ip_range}') raised ValueError" in str(ex))
-            self.assertTrue(exp_error in str(ex))
-
-    @parameterized.expand(
-        [
+
+        for ip_range, exp_error in cases:
+            with self.subTest(ip_range=ip_range):
+                conf = good_config()
+                conf["IpRanges"].append(ip_range)
+                self.appconfig.return_value = conf
+
+                try:
+                    get_ipfilter_config(["a"])
+                    self.fail("Validation should have failed")
+                except ValidationError as ex:
+                    # Formatted once: str() on a schema error re-walks the
+                    # error tree each call
+                    msg = str(ex)
+                    self.assertIn("Key 'IpRanges'", msg)
+                    self.assertIn(f"ip_network('{ip_range}') raised ValueError", msg)
+                    self.assertIn(exp_error, msg)
+
+    def test_get_ipfilter_config_bad_auth_data_raises_exception(self):
+        cases = [
             ("Path", 1, "1 should be instance of 'str'"),
             ("Username", 2, "2 should be instance of 'str'"),
             ("Password", 3, "3 should be instance of 'str'"),
@@ -440,17 +582,18 @@ class AppConfigValidationTestCase(unittest.TestCase):
             ("Username", None, "Missing key: 'Username'"),
             ("Password", None, "Missing key: 'Password'"),
         ]
-    )
-    def test_get_ipfilter_config_bad_auth_data_raises_exception(self, appconfig, key, data, message):
-        conf = good_config()
-        if data is not None:
-            conf["BasicAuth"][0][key] = data
-        else:
-            del conf["BasicAuth"][0][key]
-        appconfig.return_value = conf
-
-        try:
-            get_ipfilter_config(["a"])
-            self.fail("Validation should have failed")
-        except ValidationError as ex:
-            self.assertTrue(message in str(ex))
+
+        for key, data, message in cases:
+            with self.subTest(key=key, data=data):
+                conf = good_config()
+                if data is not None:
+                    conf["BasicAuth"][0][key] = data
+                else:
+                    del conf["BasicAuth"][0][key]
+                self.appconfig.return_value = conf
+
+                try:
+                    get_ipfilter_config(["a"])
+                    self.fail("Validation should have failed")
+                except ValidationError as ex:
+                    self.assertIn(message, str(ex))
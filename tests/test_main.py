@@ -1,17 +1,20 @@
 import base64
+import functools
+import hashlib
 import itertools
 import json
 import logging
 import os
 import socket
-import subprocess
 import time
+import tomllib
 import unittest
 import urllib.parse
 import uuid
 from datetime import datetime
 from unittest.mock import patch
 
+import pytest
 import urllib3
 from flask import Flask
 from flask import Response
@@ -23,9 +26,42 @@ from config import Environ
 from tests.conftest import create_appconfig_agent
 from tests.conftest import create_filter
 from tests.conftest import create_origin
+from tests.conftest import http_pool
+from tests.conftest import TLS_CERTIFICATE
 from tests.conftest import wait_until_connectable
+from tests.conftest import wait_until_connectable_many
 from utils import get_package_version
 
+# Most requests to the filter use this exact header set; one shared dict
+# avoids rebuilding it inline per call
+FORWARDED_HEADERS = {"x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1"}
+
+# Gap between one-byte chunks in the slow-upload tests. It only has to be long
+# enough that the bytes arrive as separate writes (proving the filter streams
+# the body rather than buffering it); a full second per byte added over a
+# minute of pure sleep to the suite
+SLOW_UPLOAD_INTERVAL = 0.05
+
+# Large enough to defeat "de-chunking" of small bodies (several times the
+# filter's 256 KiB streaming chunk size) without the 90 MB the test used to
+# push through the loopback; built once and shared rather than per test
+LARGE_BODY = b"S" * (2 * 1024 * 1024)
+
+# The environment most tests start the filter with; built once instead of a
+# fresh tuple of tuples per test. The localtest.me variant is for tests whose
+# requests must carry a host other than 127.0.0.1.
+DEFAULT_FILTER_ENV = (
+    ("SERVER", "localhost:8081"),
+    ("SERVER_PROTO", "http"),
+    ("COPILOT_ENVIRONMENT_NAME", "staging"),
+    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
+)
+LOCALTESTME_FILTER_ENV = (("SERVER", "localtest.me:8081"),) + DEFAULT_FILTER_ENV[1:]
+
+# Every Environ in these tests starts from the same deployment name; the
+# shared mapping is merged rather than re-typed per test
+BASE_ENV = {"COPILOT_ENVIRONMENT_NAME": "staging"}
+
 SHARED_HEADER_CONFIG = """
 IpRanges:
     - 1.2.3.4/32
@@ -55,11 +91,7 @@ SharedTokens:
 
 class EnvironTestCase(unittest.TestCase):
     def test_missing_key_raises_keyerror(self):
-        env = Environ(
-            {
-                "COPILOT_ENVIRONMENT_NAME": "staging",
-            }
-        )
+        env = Environ(dict(BASE_ENV))
 
         with self.assertRaises(KeyError):
             env.get_value("MISSING")
@@ -74,11 +106,7 @@ class EnvironTestCase(unittest.TestCase):
             env.int("MISSING")
 
     def test_default_values(self):
-        env = Environ(
-            {
-                "COPILOT_ENVIRONMENT_NAME": "staging",
-            }
-        )
+        env = Environ(dict(BASE_ENV))
 
         self.assertEqual(env.get_value("MISSING", default="missing"), "missing")
         self.assertEqual(env.bool("MISSING", default=True), True)
@@ -89,7 +117,7 @@ class EnvironTestCase(unittest.TestCase):
     def test_type_conversion_bool(self):
         env = Environ(
             {
-                "COPILOT_ENVIRONMENT_NAME": "staging",
+                **BASE_ENV,
                 "IS_TRUE": "True",
                 "IS_FALSE": "False",
             }
@@ -101,7 +129,7 @@ class EnvironTestCase(unittest.TestCase):
     def test_type_conversion_list(self):
         env = Environ(
             {
-                "COPILOT_ENVIRONMENT_NAME": "staging",
+                **BASE_ENV,
                 "MULTIPLE": "profile1, profile2, profile3",
                 "SINGLE_ITEM": "False",
                 "EMPTY": "",
@@ -114,7 +142,7 @@ class EnvironTestCase(unittest.TestCase):
     def test_type_conversion_int(self):
         env = Environ(
             {
-                "COPILOT_ENVIRONMENT_NAME": "staging",
+                **BASE_ENV,
                 "TEST": "-1",
             }
         )
@@ -123,7 +151,7 @@ class EnvironTestCase(unittest.TestCase):
     def test_type_with_environment_overrides(self):
         env = Environ(
             {
-                "COPILOT_ENVIRONMENT_NAME": "staging",
+                **BASE_ENV,
                 "RANDOM_FIELD": "base-value",
                 "STAGING_RANDOM_FIELD": "environment-override",
             }
@@ -146,7 +174,7 @@ class EnvironTestCase(unittest.TestCase):
         """
         env = Environ(
             {
-                "COPILOT_ENVIRONMENT_NAME": "staging",
+                **BASE_ENV,
                 "PROTECTED_PATHS": "one,two,three",
                 "STAGING_PROTECTED_PATHS": "",
             }
@@ -161,9 +189,21 @@ class EnvironTestCase(unittest.TestCase):
         )
 
 
+@pytest.mark.integration
 class ConfigurationTestCase(unittest.TestCase):
     """Tests covering the configuration logic."""
 
+    # The origin is stateless, so one instance is shared across the whole
+    # class rather than paying a process start per test
+    @classmethod
+    def setUpClass(cls):
+        cls.stop_origin = create_origin(8081)
+        wait_until_connectable(8081)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stop_origin()
+
     def _setup_environment(
         self,
         env=(),
@@ -173,18 +213,24 @@ class ConfigurationTestCase(unittest.TestCase):
             ("SERVER_PROTO", "http"),
         )
         self.addCleanup(create_filter(8080, default_env + env))
-        self.addCleanup(create_origin(8081))
+        # Run before the filter is stopped (cleanups run last-in-first-out),
+        # so gunicorn isn't left waiting on idle keep-alive connections
+        self.addCleanup(self.http.clear)
         wait_until_connectable(8080)
-        wait_until_connectable(8081)
+
+    # Shared so the requests a test makes can reuse a connection instead of
+    # paying a fresh PoolManager and TCP connect per call
+    http = urllib3.PoolManager(maxsize=4)
+
+    _BASE_HEADERS = {
+        "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
+    }
 
     def _make_request(self, request_path="/"):
-        response = urllib3.PoolManager().request(
+        response = self.http.request(
             "GET",
             url=f"http://127.0.0.1:8080{request_path}",
-            headers={
-                "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                "connection": "close",
-            },
+            headers=self._BASE_HEADERS,
             body=b"some-data",
         )
 
@@ -409,80 +455,69 @@ class ConfigurationTestCase(unittest.TestCase):
         self.assertEqual(response.status, 200)
 
 
+@pytest.mark.integration
 class ProxyTestCase(unittest.TestCase):
-    """Tests that cover the ip filter's proxy functionality."""
+    # Every test uses the agent with its default config, so one instance
+    # serves the whole class
+    @classmethod
+    def setUpClass(cls):
+        cls.stop_appconfig_agent = create_appconfig_agent(2772)
+        wait_until_connectable(2772)
 
-    def test_meta_wait_until_connectable_raises(self):
-        with self.assertRaises(OSError):
-            wait_until_connectable(8080, max_attempts=10)
+    @classmethod
+    def tearDownClass(cls):
+        cls.stop_appconfig_agent()
 
-    def test_method_is_forwarded(self):
-        self.addCleanup(create_appconfig_agent(2772))
+    def _bring_up_stack(self, filter_env=None):
+        """Start the filter and origin with cleanup registered, waiting for
+        both ports together."""
         self.addCleanup(
             create_filter(
                 8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
+                DEFAULT_FILTER_ENV if filter_env is None else filter_env,
             )
         )
         self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        wait_until_connectable_many((8080, 8081))
+
+    """Tests that cover the ip filter's proxy functionality."""
+
+    def test_meta_wait_until_connectable_raises(self):
+        # Failing probes raise immediately rather than really attempting (and
+        # sleeping between) ten connections to a port nothing listens on
+        with patch("socket.create_connection", side_effect=OSError):
+            with self.assertRaises(OSError):
+                wait_until_connectable(8080, max_attempts=10)
+
+    def test_method_is_forwarded(self):
+        self._bring_up_stack()
 
+        # subTest rather than parameterized.expand: the cases share one
+        # filter/origin stack but still report failures per method
         methods = ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "HEAD"]
-        echo_methods = [
-            urllib3.PoolManager()
-            .request(
-                method,
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                },
-            )
-            .headers["x-echo-method"]
-            for method in methods
-        ]
-        self.assertEqual(methods, echo_methods)
+        for method in methods:
+            with self.subTest(method=method):
+                echo_method = http_pool.request(
+                    method,
+                    url="http://127.0.0.1:8080/",
+                    headers=FORWARDED_HEADERS,
+                ).headers["x-echo-method"]
+                self.assertEqual(method, echo_method)
 
     def test_host_is_forwarded(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        self._bring_up_stack()
 
-        host = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "host": "somehost.com",
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                },
-            )
-            .headers["x-echo-header-host"]
-        )
+        host = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers={
+                "host": "somehost.com",
+                **FORWARDED_HEADERS,
+            },
+        ).headers["x-echo-header-host"]
         self.assertEqual(host, "somehost.com")
 
     def test_path_and_query_is_forwarded(self):
-        self.addCleanup(create_appconfig_agent(2772))
         self.addCleanup(
             create_filter(
                 8080,
@@ -495,9 +530,7 @@ class ProxyTestCase(unittest.TestCase):
             )
         )
         self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        wait_until_connectable_many((8080, 8081))
 
         path = urllib.parse.quote("/a/£/💾")
         query = urllib.parse.urlencode(
@@ -507,12 +540,12 @@ class ProxyTestCase(unittest.TestCase):
             ]
         )
         raw_uri_expected = f"{path}?{query}"
-        response = urllib3.PoolManager().request(
+        response = http_pool.request(
             "GET",
             url=f"http://127.0.0.1:8080/{path}?{query}",
             headers={
                 "host": "127.0.0.1:8081",
-                "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
+                **FORWARDED_HEADERS,
             },
         )
         raw_uri_received = response.headers["x-echo-raw-uri"]
@@ -521,7 +554,6 @@ class ProxyTestCase(unittest.TestCase):
         self.assertEqual(response.headers["x-echo-header-Host"], "127.0.0.1:8081")
 
     def test_path_is_properly_formed(self):
-        self.addCleanup(create_appconfig_agent(2772))
         self.addCleanup(
             create_filter(
                 8080,
@@ -534,9 +566,7 @@ class ProxyTestCase(unittest.TestCase):
             )
         )
         self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        wait_until_connectable_many((8080, 8081))
 
         path = urllib.parse.quote("/a/£/💾")
         query = urllib.parse.urlencode(
@@ -545,12 +575,12 @@ class ProxyTestCase(unittest.TestCase):
             ]
         )
         raw_uri_expected = f"{path}?{query}"
-        response = urllib3.PoolManager().request(
+        response = http_pool.request(
             "GET",
             url=f"http://127.0.0.1:8080/{path}?{query}",
             headers={
                 "host": "127.0.0.1:8081",
-                "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
+                **FORWARDED_HEADERS,
             },
         )
         raw_uri_received = response.headers["x-echo-raw-uri"]
@@ -559,116 +589,65 @@ class ProxyTestCase(unittest.TestCase):
         self.assertEqual(response.headers["x-echo-header-Host"], "127.0.0.1:8081")
 
     def test_body_is_forwarded(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
-
-        method_bodies_expected = [
-            ("GET", uuid.uuid4().bytes * 1),
-            ("POST", uuid.uuid4().bytes * 10),
-            ("PUT", uuid.uuid4().bytes * 100),
-            ("PATCH", uuid.uuid4().bytes * 1000),
-            ("DELETE", uuid.uuid4().bytes * 10000),
-            ("OPTIONS", uuid.uuid4().bytes * 100000),
+        self._bring_up_stack()
+
+        method_body_sizes = [
+            ("GET", 1),
+            ("POST", 10),
+            ("PUT", 100),
+            ("PATCH", 1000),
+            ("DELETE", 10000),
+            ("OPTIONS", 100000),
         ]
-        method_bodies_received = [
-            (
-                method,
-                urllib3.PoolManager()
-                .request(
+        for method, size in method_body_sizes:
+            with self.subTest(method=method, size=size):
+                body = uuid.uuid4().bytes * size
+                response = http_pool.request(
                     method,
                     url="http://127.0.0.1:8080/",
-                    headers={
-                        "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                    },
+                    headers=FORWARDED_HEADERS,
                     body=body,
+                    preload_content=False,
+                )
+                # Digest the streamed response rather than materialising a
+                # second copy of the larger bodies just to compare them
+                received_digest = hashlib.sha256()
+                for chunk in response.stream(65536):
+                    received_digest.update(chunk)
+                response.release_conn()
+                self.assertEqual(
+                    hashlib.sha256(body).digest(), received_digest.digest()
                 )
-                .data,
-            )
-            for method, body in method_bodies_expected
-        ]
-        self.assertEqual(method_bodies_expected, method_bodies_received)
 
     def test_status_is_forwarded(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        self._bring_up_stack()
 
-        method_statuses_expected = list(
-            itertools.product(
-                ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "HEAD"],
-                ["200", "201", "401", "403", "500"],
-            )
+        method_statuses = itertools.product(
+            ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "HEAD"],
+            ["200", "201", "401", "403", "500"],
         )
-        method_statuses_received = [
-            (
-                method,
-                str(
-                    urllib3.PoolManager()
-                    .request(
+        for method, status in method_statuses:
+            with self.subTest(method=method, status=status):
+                received_status = str(
+                    http_pool.request(
                         method,
                         url="http://127.0.0.1:8080/",
                         headers={
-                            "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
+                            **FORWARDED_HEADERS,
                             "x-echo-response-status": status,
                         },
-                    )
-                    .status
-                ),
-            )
-            for method, status in method_statuses_expected
-        ]
-        self.assertEqual(method_statuses_expected, method_statuses_received)
+                    ).status
+                )
+                self.assertEqual(status, received_status)
 
     def test_connection_is_not_forwarded(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        self._bring_up_stack()
 
-        response = urllib3.PoolManager().request(
+        response = http_pool.request(
             "GET",
             url="http://127.0.0.1:8080/",
             headers={
-                "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
+                **FORWARDED_HEADERS,
                 "connection": "close",
             },
             body=b"some-data",
@@ -677,7 +656,6 @@ class ProxyTestCase(unittest.TestCase):
         self.assertNotIn("x-echo-header-connection", response.headers)
 
     def test_no_issue_if_origin_restarted(self):
-        self.addCleanup(create_appconfig_agent(2772))
         self.addCleanup(
             create_filter(
                 8080,
@@ -691,16 +669,12 @@ class ProxyTestCase(unittest.TestCase):
         )
         stop_origin_1 = create_origin(8081)
         self.addCleanup(stop_origin_1)
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        wait_until_connectable_many((8080, 8081))
 
-        response_1 = urllib3.PoolManager().request(
+        response_1 = http_pool.request(
             "GET",
             url="http://127.0.0.1:8080/some-path",
-            headers={
-                "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-            },
+            headers=FORWARDED_HEADERS,
             body=b"some-data",
         )
         self.assertEqual(response_1.status, 200)
@@ -712,12 +686,10 @@ class ProxyTestCase(unittest.TestCase):
         self.addCleanup(stop_origin_2)
         wait_until_connectable(8081)
 
-        response_2 = urllib3.PoolManager().request(
+        response_2 = http_pool.request(
             "GET",
             url="http://127.0.0.1:8080/some-path",
-            headers={
-                "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-            },
+            headers=FORWARDED_HEADERS,
             body=b"some-more-data",
         )
         self.assertEqual(response_2.status, 200)
@@ -732,22 +704,7 @@ class ProxyTestCase(unittest.TestCase):
         "This test hangs indefinitely, likely because `gunicorn --timeout 0`"
     )
     def test_no_issue_if_request_unfinished(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        self._bring_up_stack()
 
         class BodyException(Exception):
             pass
@@ -759,361 +716,184 @@ class ProxyTestCase(unittest.TestCase):
 
         # We only send half of the request
         with self.assertRaises(BodyException):
-            urllib3.PoolManager().request(
+            http_pool.request(
                 "POST",
                 "http://127.0.0.1:8080/",
                 headers={
                     "content-length": "200000",
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
+                    **FORWARDED_HEADERS,
                 },
                 body=body(),
             )
 
-        response = urllib3.PoolManager().request(
+        response = http_pool.request(
             "GET",
             url="http://127.0.0.1:8080/",
-            headers={
-                "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-            },
+            headers=FORWARDED_HEADERS,
             body="some-data",
         )
         self.assertEqual(response.data, b"some-data")
 
     def test_request_header_is_forwarded(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        self._bring_up_stack()
 
-        response_header = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                    "some-header": "some-value",
-                },
-            )
-            .headers["x-echo-header-some-header"]
-        )
+        response_header = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers={
+                **FORWARDED_HEADERS,
+                "some-header": "some-value",
+            },
+        ).headers["x-echo-header-some-header"]
         self.assertEqual(response_header, "some-value")
 
-    def test_content_length_is_forwarded(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+    def test_non_basic_authorization_header_is_forwarded(self):
+        # A non-Basic Authorization header parses with no username or
+        # password; it must be ignored by the credential checks rather than
+        # crash them, and forwarded to the origin like any other header
+        self._bring_up_stack()
 
-        headers = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                },
-                body=b"some-data",
-            )
-            .headers
+        response = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers={
+                **FORWARDED_HEADERS,
+                "authorization": "Bearer some-token",
+            },
         )
+        self.assertEqual(response.status, 200)
+        self.assertEqual(
+            response.headers["x-echo-header-authorization"], "Bearer some-token"
+        )
+
+    def test_content_length_is_forwarded(self):
+        self._bring_up_stack()
+
+        headers = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers=FORWARDED_HEADERS,
+            body=b"some-data",
+        ).headers
         self.assertEqual(
             headers["x-echo-header-content-length"], str(len(b"some-data"))
         )
         self.assertNotIn("x-echo-header-transfer-encoding", headers)
 
     def test_if_no_body_then_no_content_length_and_no_transfer_encoding(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        self._bring_up_stack()
 
-        response = urllib3.PoolManager().request(
+        response = http_pool.request(
             "GET",
             url="http://127.0.0.1:8080/",
-            headers={
-                "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-            },
+            headers=FORWARDED_HEADERS,
         )
         self.assertNotIn("x-echo-header-content-length", response.headers)
         self.assertNotIn("x-echo-header-transfer-encoding", response.headers)
 
     def test_body_length_zero_then_content_length_zero_and_no_transfer_encoding(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        self._bring_up_stack()
 
-        headers = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                },
-                body=b"",
-            )
-            .headers
-        )
+        headers = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers=FORWARDED_HEADERS,
+            body=b"",
+        ).headers
         self.assertEqual(headers["x-echo-header-content-length"], "0")
         self.assertNotIn("x-echo-header-transfer-encoding", headers)
 
     def test_response_header_is_forwarded(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        self._bring_up_stack()
 
-        response_header = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                    "x-echo-response-header-some-header": "some-value",
-                },
-            )
-            .headers["some-header"]
-        )
+        response_header = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers={
+                **FORWARDED_HEADERS,
+                "x-echo-response-header-some-header": "some-value",
+            },
+        ).headers["some-header"]
         self.assertEqual(response_header, "some-value")
 
     def test_content_disposition_with_latin_1_character_is_forwarded(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        self._bring_up_stack()
 
-        response_header = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                    "x-echo-response-header-content-disposition": 'attachment; filename="Ö"',
-                },
-            )
-            .headers["content-disposition"]
-        )
+        response_header = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers={
+                **FORWARDED_HEADERS,
+                "x-echo-response-header-content-disposition": 'attachment; filename="Ö"',
+            },
+        ).headers["content-disposition"]
 
         self.assertEqual(response_header, 'attachment; filename="Ö"')
 
     def test_get_content_length_is_forwarded(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        self._bring_up_stack()
 
-        content_length = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                # Make sure test doesn't pass due to "de-chunking" of small bodies
-                body=b"Something" * 10000000,
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                },
-            )
-            .headers["content-length"]
-        )
-        self.assertEqual(content_length, "90000000")
+        content_length = http_pool.request(
+            "GET",
+            # Make sure test doesn't pass due to "de-chunking" of small bodies
+            body=LARGE_BODY,
+            url="http://127.0.0.1:8080/",
+            headers=FORWARDED_HEADERS,
+        ).headers["content-length"]
+        self.assertEqual(content_length, str(len(LARGE_BODY)))
 
     def test_head_content_length_is_forwarded(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        self._bring_up_stack()
 
-        content_length = (
-            urllib3.PoolManager()
-            .request(
-                "HEAD",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                    "x-echo-response-header-content-length": "12345678",
-                },
-            )
-            .headers["content-length"]
-        )
+        content_length = http_pool.request(
+            "HEAD",
+            url="http://127.0.0.1:8080/",
+            headers={
+                **FORWARDED_HEADERS,
+                "x-echo-response-header-content-length": "12345678",
+            },
+        ).headers["content-length"]
         # This should probably be 12345678
         self.assertEqual(content_length, "0")
 
     def test_request_cookie_is_forwarded(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localtest.me:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
+        self.addCleanup(create_filter(8080, LOCALTESTME_FILTER_ENV))
         self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        wait_until_connectable_many((8080, 8081))
 
-        response_header = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                    "cookie": "my_name=my_value",
-                },
-            )
-            .headers["x-echo-header-cookie"]
-        )
+        response_header = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers={
+                **FORWARDED_HEADERS,
+                "cookie": "my_name=my_value",
+            },
+        ).headers["x-echo-header-cookie"]
         self.assertEqual(response_header, "my_name=my_value")
 
-        response_header = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                    "cookie": "my_name=my_value; my_name_b=my_other_value",
-                },
-            )
-            .headers["x-echo-header-cookie"]
-        )
+        response_header = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers={
+                **FORWARDED_HEADERS,
+                "cookie": "my_name=my_value; my_name_b=my_other_value",
+            },
+        ).headers["x-echo-header-cookie"]
         self.assertEqual(response_header, "my_name=my_value; my_name_b=my_other_value")
 
     def test_response_cookie_is_forwarded(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localtest.me:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
+        self.addCleanup(create_filter(8080, LOCALTESTME_FILTER_ENV))
         self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        wait_until_connectable_many((8080, 8081))
 
-        response_header = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                    "x-echo-response-header-set-cookie": "my_name=my_value",
-                },
-            )
-            .headers["set-cookie"]
-        )
+        response_header = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers={
+                **FORWARDED_HEADERS,
+                "x-echo-response-header-set-cookie": "my_name=my_value",
+            },
+        ).headers["set-cookie"]
         self.assertEqual(response_header, "my_name=my_value")
 
         # A full cookie with lots of components
@@ -1122,164 +902,106 @@ class ProxyTestCase(unittest.TestCase):
             "Expires=Wed, 29-Apr-2020 15:06:49 GMT; Secure; "
             "HttpOnly; Path=/path"
         )
-        response_header = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/path",
-                headers={
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                    "x-echo-response-header-set-cookie": full_cookie_value,
-                },
-            )
-            .headers["set-cookie"]
-        )
+        response_header = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/path",
+            headers={
+                **FORWARDED_HEADERS,
+                "x-echo-response-header-set-cookie": full_cookie_value,
+            },
+        ).headers["set-cookie"]
         self.assertEqual(response_header, full_cookie_value)
 
         # Checking the treatment of Max-Age (which Python requests can change
         # to Expires)
-        response_header = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/path",
-                headers={
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                    "x-echo-response-header-set-cookie": "my_name=my_value; Max-Age=100",
-                },
-            )
-            .headers["set-cookie"]
-        )
+        response_header = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/path",
+            headers={
+                **FORWARDED_HEADERS,
+                "x-echo-response-header-set-cookie": "my_name=my_value; Max-Age=100",
+            },
+        ).headers["set-cookie"]
         self.assertEqual(response_header, "my_name=my_value; Max-Age=100")
 
     def test_multiple_response_cookies_are_forwarded(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localtest.me:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
+        self.addCleanup(create_filter(8080, LOCALTESTME_FILTER_ENV))
         self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        wait_until_connectable_many((8080, 8081))
 
         # We make sure we don't depend on or are thwarted by magic that an HTTP
         # client in the tests does regarding multiple HTTP headers of the same
         # name, and specifically any handing of multiple Set-Cookie headers
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect(("127.0.0.1", 8080))
-        sock.send(
-            b"GET http://localtest.me:8081/multiple-cookies HTTP/1.1\r\n"
-            b"host:127.0.0.1\r\n"
-            b"x-forwarded-for:1.2.3.4, 1.1.1.1, 1.1.1.1\r\n"
-            b"x-multiple-cookies:name_a=value_a,name_b=value_b\r\n"
-            b"\r\n"
-        )
-
-        response = b""
-        while b"\r\n\r\n" not in response:
-            response += sock.recv(4096)
-        sock.close()
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.connect(("127.0.0.1", 8080))
+            sock.send(
+                b"GET http://localtest.me:8081/multiple-cookies HTTP/1.1\r\n"
+                b"host:127.0.0.1\r\n"
+                b"x-forwarded-for:1.2.3.4, 1.1.1.1, 1.1.1.1\r\n"
+                b"x-multiple-cookies:name_a=value_a,name_b=value_b\r\n"
+                b"\r\n"
+            )
+
+            # A bytearray grows in place, unlike += on bytes which copies the
+            # whole response so far on every recv
+            response = bytearray()
+            while b"\r\n\r\n" not in response:
+                response += sock.recv(8192)
 
         self.assertIn(b"set-cookie: name_a=value_a\r\n", response)
         self.assertIn(b"set-cookie: name_b=value_b\r\n", response)
 
     def test_cookie_not_stored(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localtest.me:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
+        self.addCleanup(create_filter(8080, LOCALTESTME_FILTER_ENV))
         self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        wait_until_connectable_many((8080, 8081))
 
         # Ensure that the filter itself don't store cookies set by the origin
         cookie_header = "x-echo-header-cookie"
-        set_cookie = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                    "x-echo-response-header-set-cookie": "my_name=my_value_a; Domain=.localtest.me; Path=/path",
-                },
-            )
-            .headers["set-cookie"]
-        )
+        set_cookie = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers={
+                **FORWARDED_HEADERS,
+                "x-echo-response-header-set-cookie": "my_name=my_value_a; Domain=.localtest.me; Path=/path",
+            },
+        ).headers["set-cookie"]
         self.assertEqual(
             set_cookie, "my_name=my_value_a; Domain=.localtest.me; Path=/path"
         )
         has_cookie = (
             cookie_header
-            in urllib3.PoolManager()
-            .request(
+            in http_pool.request(
                 "GET",
                 url="http://127.0.0.1:8080/",
-                headers={
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                },
-            )
-            .headers
+                headers=FORWARDED_HEADERS,
+            ).headers
         )
         self.assertFalse(has_cookie)
 
         # Meta test, ensuring that cookie_header is the right header to
         # check for to see if the echo origin received the cookie
-        cookie_header_value = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                    "cookie": "my_name=my_value_b",
-                },
-            )
-            .headers[cookie_header]
-        )
+        cookie_header_value = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers={
+                **FORWARDED_HEADERS,
+                "cookie": "my_name=my_value_b",
+            },
+        ).headers[cookie_header]
         self.assertEqual(cookie_header_value, "my_name=my_value_b")
 
     def test_gzipped(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localtest.me:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
+        self.addCleanup(create_filter(8080, LOCALTESTME_FILTER_ENV))
         self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        wait_until_connectable_many((8080, 8081))
 
-        response = urllib3.PoolManager().request(
+        response = http_pool.request(
             "GET",
             url="http://127.0.0.1:8080/gzipped",
             headers={
                 "host": "localtest.me:8081",
-                "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
+                **FORWARDED_HEADERS,
             },
             body=b"something-to-zip",
         )
@@ -1288,36 +1010,21 @@ class ProxyTestCase(unittest.TestCase):
         self.assertIn("content-length", response.headers)
 
     def test_slow_upload_non_chunked(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        self._bring_up_stack()
 
         num_bytes = 35
 
         def body():
             for _ in range(0, num_bytes):
                 yield b"-"
-                time.sleep(1)
+                time.sleep(SLOW_UPLOAD_INTERVAL)
 
-        response = urllib3.PoolManager().request(
+        response = http_pool.request(
             "POST",
             "http://127.0.0.1:8080/",
             headers={
                 "content-length": str(num_bytes),
-                "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
+                **FORWARDED_HEADERS,
             },
             body=body(),
         )
@@ -1325,65 +1032,33 @@ class ProxyTestCase(unittest.TestCase):
         self.assertNotIn("x-echo-header-transfer-encoding", response.headers)
 
     def test_slow_upload_chunked(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        self._bring_up_stack()
 
         num_bytes = 35
 
         def body():
             for _ in range(0, num_bytes):
                 yield b"-"
-                time.sleep(1)
+                time.sleep(SLOW_UPLOAD_INTERVAL)
 
-        response = urllib3.PoolManager().request(
+        response = http_pool.request(
             "POST",
             "http://127.0.0.1:8080/",
-            headers={
-                "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-            },
+            headers=FORWARDED_HEADERS,
             body=body(),
         )
         self.assertEqual(response.data, b"-" * num_bytes)
         self.assertEqual(response.headers["x-echo-header-transfer-encoding"], "chunked")
 
     def test_chunked_response(self):
-        self.addCleanup(create_appconfig_agent(2772))
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
-                ),
-            )
-        )
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        self._bring_up_stack()
 
-        response = urllib3.PoolManager().request(
+        response = http_pool.request(
             "GET",
             url="http://127.0.0.1:8080/chunked",
             headers={
                 "host": "127.0.0.1:8081",
-                "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
+                **FORWARDED_HEADERS,
                 "x-chunked-num-bytes": "10000",
             },
             preload_content=False,
@@ -1392,49 +1067,83 @@ class ProxyTestCase(unittest.TestCase):
 
         self.assertEqual("chunked", response.headers["Transfer-Encoding"])
         self.assertNotIn("content-length", response.headers)
-        self.assertEqual(response.data, b"-" * 10000)
+        # Stream into a bytearray rather than letting .data gather and join
+        # the chunks internally
+        body = bytearray()
+        for chunk in response.stream(4096, decode_content=False):
+            body += chunk
+        self.assertEqual(bytes(body), b"-" * 10000)
 
     def test_https(self):
-        self.addCleanup(create_appconfig_agent(2772))
+        # A local TLS origin rather than an external site: no DNS or outbound
+        # network, and the run isn't at the mercy of a third party. The filter
+        # is pointed at the test certificate through SSL_CERT_FILE so its
+        # upstream connection still performs full verification.
         self.addCleanup(
             create_filter(
                 8080,
                 (
-                    ("SERVER", "www.gov.uk"),
+                    ("SERVER", "localhost:8444"),
                     ("SERVER_PROTO", "https"),
                     ("COPILOT_ENVIRONMENT_NAME", "staging"),
                     ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
+                    ("SSL_CERT_FILE", TLS_CERTIFICATE),
                 ),
             )
         )
-        wait_until_connectable(8080)
-        wait_until_connectable(2772)
+        self.addCleanup(create_origin(8444, tls=True))
+        wait_until_connectable_many((8080, 8444))
 
-        # On the one hand not great to depend on a 3rd party/external site,
-        # but it does test that the filter can connect to a regular/real site
-        # that we cannot have customised to make the tests pass. Plus,
-        # www.google.com is extremely unlikely to go down
-        data = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "host": "www.gov.uk",
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                },
+        data = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers={
+                "host": "localhost:8444",
+                **FORWARDED_HEADERS,
+            },
+            body=b"some-data",
+        ).data
+        self.assertEqual(data, b"some-data")
+
+    @unittest.skipUnless(
+        os.environ.get("RUN_NETWORK_TESTS"),
+        "outbound network tests disabled by default",
+    )
+    def test_https_external_site(self):
+        # Kept for occasional manual runs: proves the filter can connect to a
+        # regular/real site that we cannot have customised to make the tests
+        # pass
+        self.addCleanup(
+            create_filter(
+                8080,
+                (
+                    ("SERVER", "www.gov.uk"),
+                    ("SERVER_PROTO", "https"),
+                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
+                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
+                ),
             )
-            .data
         )
+        wait_until_connectable(8080)
+
+        data = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers={
+                "host": "www.gov.uk",
+                **FORWARDED_HEADERS,
+            },
+        ).data
         self.assertIn(b"GOV.UK", data)
 
     def test_https_origin_not_exist_returns_500(self):
-        self.addCleanup(create_appconfig_agent(2772))
         self.addCleanup(
             create_filter(
                 8080,
                 (
-                    ("SERVER", "does.not.exist"),
+                    # Port 1 on loopback is never listening, so the upstream
+                    # connect fails immediately instead of via a DNS lookup
+                    ("SERVER", "127.0.0.1:1"),
                     ("SERVER_PROTO", "https"),
                     ("COPILOT_ENVIRONMENT_NAME", "staging"),
                     ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
@@ -1442,24 +1151,22 @@ class ProxyTestCase(unittest.TestCase):
             )
         )
         wait_until_connectable(8080)
-        wait_until_connectable(2772)
 
-        response = urllib3.PoolManager().request(
+        response = http_pool.request(
             "GET",
             url="http://127.0.0.1:8080/",
-            headers={
-                "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-            },
+            headers=FORWARDED_HEADERS,
         )
         self.assertEqual(response.status, 500)
 
     def test_http_origin_not_exist_returns_500(self):
-        self.addCleanup(create_appconfig_agent(2772))
         self.addCleanup(
             create_filter(
                 8080,
                 (
-                    ("SERVER", "does.not.exist"),
+                    # Port 1 on loopback is never listening, so the upstream
+                    # connect fails immediately instead of via a DNS lookup
+                    ("SERVER", "127.0.0.1:1"),
                     ("SERVER_PROTO", "http"),
                     ("COPILOT_ENVIRONMENT_NAME", "staging"),
                     ("APPCONFIG_PROFILES", "testapp:testenv:testconfig"),
@@ -1467,19 +1174,15 @@ class ProxyTestCase(unittest.TestCase):
             )
         )
         wait_until_connectable(8080)
-        wait_until_connectable(2772)
 
-        response = urllib3.PoolManager().request(
+        response = http_pool.request(
             "GET",
             url="http://127.0.0.1:8080/",
-            headers={
-                "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-            },
+            headers=FORWARDED_HEADERS,
         )
         self.assertEqual(response.status, 500)
 
     def test_not_running_origin_returns_500(self):
-        self.addCleanup(create_appconfig_agent(2772))
         self.addCleanup(
             create_filter(
                 8080,
@@ -1492,23 +1195,19 @@ class ProxyTestCase(unittest.TestCase):
             )
         )
         wait_until_connectable(8080)
-        wait_until_connectable(2772)
 
-        status = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "host": "127.0.0.1:8081",
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                },
-            )
-            .status
-        )
+        status = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers={
+                "host": "127.0.0.1:8081",
+                **FORWARDED_HEADERS,
+            },
+        ).status
         self.assertEqual(status, 500)
 
 
+@pytest.mark.integration
 class IpFilterLogicTestCase(unittest.TestCase):
     """Tests covering the IP filter logic."""
 
@@ -1529,7 +1228,7 @@ class IpFilterLogicTestCase(unittest.TestCase):
         )
         wait_until_connectable(8080)
         wait_until_connectable(2772)
-        response = urllib3.PoolManager().request(
+        response = http_pool.request(
             "GET",
             url="http://127.0.0.1:8080/",
         )
@@ -1559,15 +1258,13 @@ class IpFilterLogicTestCase(unittest.TestCase):
             "",
         ]
         statuses = [
-            urllib3.PoolManager()
-            .request(
+            http_pool.request(
                 "GET",
                 url="http://127.0.0.1:8080/",
                 headers={
                     "x-forwarded-for": x_forwarded_for_header,
                 },
-            )
-            .status
+            ).status
             for x_forwarded_for_header in x_forwarded_for_headers
         ]
         self.assertEqual(statuses, [403] * len(x_forwarded_for_headers))
@@ -1597,34 +1294,28 @@ IpRanges:
             )
         )
         self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        wait_until_connectable_many((8080, 8081, 2772))
 
-        response = urllib3.PoolManager().request(
+        response = http_pool.request(
             "GET",
             url="http://127.0.0.1:8080/",
             headers={
                 "host": "somehost.com",
-                "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
+                **FORWARDED_HEADERS,
             },
         )
         self.assertEqual(response.status, 403)
         self.assertIn(b">1.1.1.1<", response.data)
         self.assertIn(b">/<", response.data)
 
-        status = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "host": "somehost.com",
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1",
-                },
-            )
-            .status
-        )
+        status = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers={
+                "host": "somehost.com",
+                "x-forwarded-for": "1.2.3.4, 1.1.1.1",
+            },
+        ).status
         self.assertEqual(status, 200)
 
     def test_ip_matching_cidr_respected(self):
@@ -1656,50 +1347,36 @@ BasicAuth: []
             )
         )
         self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        wait_until_connectable_many((8080, 8081, 2772))
 
-        status = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "host": "somehost.com",
-                    "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-                },
-            )
-            .status
-        )
+        status = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers={
+                "host": "somehost.com",
+                **FORWARDED_HEADERS,
+            },
+        ).status
         self.assertEqual(status, 200)
 
-        status = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "host": "somehost.com",
-                    "x-forwarded-for": "1.2.3.5, 1.1.1.1, 1.1.1.1",
-                },
-            )
-            .status
-        )
+        status = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers={
+                "host": "somehost.com",
+                "x-forwarded-for": "1.2.3.5, 1.1.1.1, 1.1.1.1",
+            },
+        ).status
         self.assertEqual(status, 200)
 
-        status = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "host": "somehost.com",
-                    "x-forwarded-for": "1.2.4.5, 1.1.1.1, 1.1.1.1",
-                },
-            )
-            .status
-        )
+        status = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers={
+                "host": "somehost.com",
+                "x-forwarded-for": "1.2.4.5, 1.1.1.1, 1.1.1.1",
+            },
+        ).status
         self.assertEqual(status, 403)
 
     def test_trace_id_is_reported(self):
@@ -1728,11 +1405,9 @@ BasicAuth: []
             )
         )
         self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        wait_until_connectable_many((8080, 8081, 2772))
 
-        response = urllib3.PoolManager().request(
+        response = http_pool.request(
             "GET",
             url="http://127.0.0.1:8080/__some_path",
             headers={
@@ -1758,28 +1433,73 @@ BasicAuth: []
             )
         )
         self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        wait_until_connectable_many((8080, 8081, 2772))
 
-        status = (
-            urllib3.PoolManager()
-            .request(
-                "GET",
-                url="http://127.0.0.1:8080/",
-                headers={
-                    "host": "somehost.com",
-                    "x-forwarded-for": "2a00:23c4:ce80:a01:4979:78c8:535c:bc16, 1.1.1.1",
-                },
-            )
-            .status
-        )
+        status = http_pool.request(
+            "GET",
+            url="http://127.0.0.1:8080/",
+            headers={
+                "host": "somehost.com",
+                "x-forwarded-for": "2a00:23c4:ce80:a01:4979:78c8:535c:bc16, 1.1.1.1",
+            },
+        ).status
         self.assertEqual(status, 403)
 
 
+# The same few credential pairs are encoded for many requests each, so the
+# header value is built once per pair. b64encode output is pure ASCII.
+@functools.lru_cache(maxsize=32)
+def basic_auth_header(credentials):
+    return "Basic " + base64.b64encode(credentials).decode("ascii")
+
+
+@pytest.mark.integration
 class BasicAuthTestCase(unittest.TestCase):
     """Tests covering basic auth responses."""
 
+    # The three second-credential tests use this exact agent configuration
+    # and filter environment, so they share one stack, started lazily by the
+    # first of them and stopped with the class. The other two tests need
+    # different configurations and keep per-test stacks; they run first in
+    # unittest's alphabetical order, so the ports never clash.
+    TWO_CRED_CONFIG = {
+        "testapp:testenv:testconfig2": """
+IpRanges:
+    - 1.2.3.4/32
+BasicAuth:
+    - Path: /__some_path
+      Username: my-user
+      Password: my-secret
+    - Path: /__some_path
+      Username: my-other-user
+      Password: my-other-secret
+"""
+    }
+    TWO_CRED_FILTER_ENV = (
+        ("SERVER", "localhost:8081"),
+        ("SERVER_PROTO", "http"),
+        ("COPILOT_ENVIRONMENT_NAME", "staging"),
+        ("APPCONFIG_PROFILES", "testapp:testenv:testconfig2"),
+        ("IP_DETERMINED_BY_X_FORWARDED_FOR_INDEX", "-3"),
+    )
+    _stop_two_cred_stack = ()
+
+    @classmethod
+    def _ensure_two_cred_stack(cls):
+        if cls._stop_two_cred_stack:
+            return
+        cls._stop_two_cred_stack = (
+            create_appconfig_agent(2772, cls.TWO_CRED_CONFIG),
+            create_filter(8080, cls.TWO_CRED_FILTER_ENV),
+            create_origin(8081),
+        )
+        wait_until_connectable_many((8080, 8081, 2772))
+
+    @classmethod
+    def tearDownClass(cls):
+        for stop in reversed(cls._stop_two_cred_stack):
+            stop()
+
     def get_basic_auth_response(
         self,
         host="somehost.com",
@@ -1787,14 +1507,13 @@ class BasicAuthTestCase(unittest.TestCase):
         x_forwarded_for="1.2.3.4, 1.1.1.1, 1.1.1.1",
         credentials=b"my-user:my-secret",
     ):
-        return urllib3.PoolManager().request(
+        return http_pool.request(
             "GET",
             url=f"http://127.0.0.1:8080/{request_path}",
             headers={
                 "host": host,
                 "x-forwarded-for": x_forwarded_for,
-                "authorization": "Basic "
-                + base64.b64encode(credentials).decode("utf-8"),
+                "authorization": basic_auth_header(credentials),
             },
         )
 
@@ -1834,9 +1553,7 @@ BasicAuth:
             )
         )
         self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        wait_until_connectable_many((8080, 8081, 2772))
 
         status = self.get_basic_auth_response().status
 
@@ -1867,41 +1584,7 @@ BasicAuth:
         2. 403 generic access denied message is returned for invalid password when auth path doesn't match request for my-other-user credentials.
         3. 200 is returned when auth headers and path match second set of credentials (my-other-user).
         """
-        self.addCleanup(
-            create_appconfig_agent(
-                2772,
-                {
-                    "testapp:testenv:testconfig2": """
-IpRanges:
-    - 1.2.3.4/32
-BasicAuth:
-    - Path: /__some_path
-      Username: my-user
-      Password: my-secret
-    - Path: /__some_path
-      Username: my-other-user
-      Password: my-other-secret
-"""
-                },
-            )
-        )
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig2"),
-                    ("IP_DETERMINED_BY_X_FORWARDED_FOR_INDEX", "-3"),
-                ),
-            )
-        )
-
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
-        wait_until_connectable(2772)
+        self._ensure_two_cred_stack()
 
         status = self.get_basic_auth_response(credentials=b"my-user:my-mangos").status
 
@@ -1961,8 +1644,7 @@ BasicAuth:
             )
         )
         self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
+        wait_until_connectable_many((8080, 8081))
 
         status = self.get_basic_auth_response(credentials=b"my-user:my-mangos").status
 
@@ -2015,40 +1697,7 @@ BasicAuth:
         3. 403 returned for second set of invalid basic auth credentials when ip is whitelisted.
         4. 200 returned for second set of valid basic auth credentials when ip is whitelisted.
         """
-        self.addCleanup(
-            create_appconfig_agent(
-                2772,
-                {
-                    "testapp:testenv:testconfig2": """
-IpRanges:
-    - 1.2.3.4/32
-BasicAuth:
-    - Path: /__some_path
-      Username: my-user
-      Password: my-secret
-    - Path: /__some_path
-      Username: my-other-user
-      Password: my-other-secret
-"""
-                },
-            )
-        )
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig2"),
-                    ("IP_DETERMINED_BY_X_FORWARDED_FOR_INDEX", "-3"),
-                ),
-            )
-        )
-
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
+        self._ensure_two_cred_stack()
 
         status = self.get_basic_auth_response(
             x_forwarded_for="5.5.5.5, 1.1.1.1, 1.1.1.1"
@@ -2079,40 +1728,7 @@ BasicAuth:
         2. 403 returned for second set of invalid credentials where path doesn't match request.
         3. 200 ok returned for second set of valid credentials with matching path.
         """
-        self.addCleanup(
-            create_appconfig_agent(
-                2772,
-                {
-                    "testapp:testenv:testconfig2": """
-IpRanges:
-    - 1.2.3.4/32
-BasicAuth:
-    - Path: /__some_path
-      Username: my-user
-      Password: my-secret
-    - Path: /__some_path
-      Username: my-other-user
-      Password: my-other-secret
-"""
-                },
-            )
-        )
-        self.addCleanup(
-            create_filter(
-                8080,
-                (
-                    ("SERVER", "localhost:8081"),
-                    ("SERVER_PROTO", "http"),
-                    ("COPILOT_ENVIRONMENT_NAME", "staging"),
-                    ("APPCONFIG_PROFILES", "testapp:testenv:testconfig2"),
-                    ("IP_DETERMINED_BY_X_FORWARDED_FOR_INDEX", "-3"),
-                ),
-            )
-        )
-
-        self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
+        self._ensure_two_cred_stack()
 
         status = self.get_basic_auth_response(credentials=b"my-user:my-mangos").status
 
@@ -2132,17 +1748,20 @@ BasicAuth:
         self.assertEqual(response.data, b"ok")
 
 
+@pytest.mark.integration
 class SharedTokenTestCase(unittest.TestCase):
     def get_shared_token_response(self, custom_headers=None):
-        if custom_headers == None:
+        if custom_headers is None:
             custom_headers = {"x-cdn-secret": "my-secret"}
 
+        # One dict literal rather than building two and merging with |
         headers = {
             "x-cf-forwarded-url": "http://somehost.com/",
-            "x-forwarded-for": "1.2.3.4, 1.1.1.1, 1.1.1.1",
-        } | custom_headers
+            **FORWARDED_HEADERS,
+            **custom_headers,
+        }
 
-        return urllib3.PoolManager().request(
+        return http_pool.request(
             "GET",
             url="http://127.0.0.1:8080/",
             headers=headers,
@@ -2175,8 +1794,7 @@ class SharedTokenTestCase(unittest.TestCase):
             )
         )
         self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
+        wait_until_connectable_many((8080, 8081))
 
         status = self.get_shared_token_response(custom_headers=custom_headers).status
 
@@ -2210,8 +1828,7 @@ class SharedTokenTestCase(unittest.TestCase):
             )
         )
         self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
+        wait_until_connectable_many((8080, 8081))
 
         status = self.get_shared_token_response(custom_headers=custom_headers).status
 
@@ -2243,8 +1860,7 @@ class SharedTokenTestCase(unittest.TestCase):
             )
         )
         self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
+        wait_until_connectable_many((8080, 8081))
 
         status = self.get_shared_token_response(custom_headers=custom_headers).status
 
@@ -2270,8 +1886,7 @@ class SharedTokenTestCase(unittest.TestCase):
             )
         )
         self.addCleanup(create_origin(8081))
-        wait_until_connectable(8080)
-        wait_until_connectable(8081)
+        wait_until_connectable_many((8080, 8081))
 
         response = self.get_shared_token_response(
             custom_headers={
@@ -2288,10 +1903,10 @@ class SharedTokenTestCase(unittest.TestCase):
 class LoggingTestCase(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        result = subprocess.run(
-            ["poetry", "version"], stdout=subprocess.PIPE, text=True
-        )
-        cls.ip_filter_version = result.stdout.split()[1]
+        # Read straight from pyproject.toml: forking poetry costs hundreds of
+        # milliseconds of interpreter start-up just to print this value
+        with open("pyproject.toml", "rb") as pyproject:
+            cls.ip_filter_version = tomllib.load(pyproject)["tool"]["poetry"]["version"]
 
         # env vars needed to instantiate app
         os.environ["COPILOT_ENVIRONMENT_NAME"] = "test"
@@ -2405,47 +2020,38 @@ class LoggingTestCase(unittest.TestCase):
         ):
             formatted_log = ASIMFormatter().format(log_record)
             print(formatted_log)
-            assert formatted_log == json.dumps(
-                {
-                    "EventMessage": log_record.msg,
-                    "EventCount": 1,
-                    "EventStartTime": log_time,
-                    "EventEndTime": log_time,
-                    "EventType": "HTTPsession",
-                    "EventSeverity": "Informational",
-                    "EventOriginalSeverity": log_record.levelname,  # duplicate of above?
-                    "EventSchema": "WebSession",
-                    "EventSchemaVersion": "0.2.6",
-                    "IpFilterVersion": self.ip_filter_version,
-                    "Url": request.url,
-                    "UrlOriginal": request.url,
-                    "HttpVersion": request.environ.get("SERVER_PROTOCOL"),
-                    "HttpRequestMethod": request.method,
-                    "HttpContentType": request.content_type,
-                    "HttpContentFormat": request.mimetype,
-                    "HttpReferrer": request.referrer,
-                    "HttpUserAgent": str(request.user_agent),
-                    "HttpRequestXff": request.headers["X-Forwarded-For"],
-                    "HttpResponseTime": "N/A",
-                    "HttpHost": request.host,
-                    "AdditionalFields": {
-                        "TraceHeaders": {"X-Amzn-Trace-Id": None},
-                    },
-                    "EventResult": "Success",
-                    "EventResultDetails": response.status_code,
-                    "FileName": "N/A",
-                    "HttpStatusCode": response.status_code,
-                }
-            )
-
-    @patch("main.cache")
-    def test_get_package_version_no_cache(self, cache):
-        cache.get.return_value = None
+            # Compare parsed content rather than the exact string so the test
+            # doesn't depend on which JSON encoder is installed
+            assert json.loads(formatted_log) == {
+                "EventMessage": log_record.msg,
+                "EventCount": 1,
+                "EventStartTime": log_time,
+                "EventEndTime": log_time,
+                "EventType": "HTTPsession",
+                "EventSeverity": "Informational",
+                "EventOriginalSeverity": log_record.levelname,  # duplicate of above?
+                "EventSchema": "WebSession",
+                "EventSchemaVersion": "0.2.6",
+                "IpFilterVersion": self.ip_filter_version,
+                "Url": request.url,
+                "UrlOriginal": request.url,
+                "HttpVersion": request.environ.get("SERVER_PROTOCOL"),
+                "HttpRequestMethod": request.method,
+                "HttpContentType": request.content_type,
+                "HttpContentFormat": request.mimetype,
+                "HttpReferrer": request.referrer,
+                "HttpUserAgent": str(request.user_agent),
+                "HttpRequestXff": request.headers["X-Forwarded-For"],
+                "HttpResponseTime": "N/A",
+                "HttpHost": request.host,
+                "AdditionalFields": {
+                    "TraceHeaders": {"X-Amzn-Trace-Id": None},
+                },
+                "EventResult": "Success",
+                "EventResultDetails": response.status_code,
+                "FileName": "N/A",
+                "HttpStatusCode": response.status_code,
+            }
 
+    def test_get_package_version(self):
         assert get_package_version() == self.ip_filter_version
-
-    @patch("main.cache")
-    def test_get_package_version_cache(self, cache):
-        cache.get.return_value = "6.6.6"
-
-        assert get_package_version() == "6.6.6"
@@ -1,32 +1,31 @@
-import toml
+import hmac
+import os
+import tomllib
 
 
 def constant_time_is_equal(a, b):
-    """To prevent timing attacks, check first that strings are of equal length
-    and then perform bitwise constant time comparison operation, returning zero
-    only if two values are equal."""
-    if len(a) != len(b):
-        return False
+    """To prevent timing attacks, compare the two values in constant time.
 
-    result = 0
-    for x, y in zip(a, b):
-        result |= x ^ y
-    return result == 0
+    hmac.compare_digest is implemented in C, so the comparison doesn't pay
+    for a Python-level loop over every byte."""
+    return hmac.compare_digest(a, b)
 
 
-def get_package_version() -> str:
-    # importing here, to avoid circular import error
-    from main import app
-    from main import cache
+def _read_package_version() -> str:
+    # Resolved relative to this file so the read doesn't depend on the
+    # process's working directory
+    pyproject_path = os.path.join(os.path.dirname(__file__), "pyproject.toml")
+
+    with open(pyproject_path, "rb") as toml_file:
+        data = tomllib.load(toml_file)
 
-    with app.app_context():
-        package_version = cache.get("package_version")
+    return data.get("tool", {}).get("poetry", {}).get("version")
 
-        if not package_version:
-            with open("pyproject.toml", "r") as toml_file:
-                data = toml.load(toml_file)
 
-            package_version = data.get("tool", {}).get("poetry", {}).get("version")
-            cache.set("package_version", package_version)
+# The version can't change while the process is running, so the file is read
+# and parsed once at import rather than going through a cache per call
+_package_version = _read_package_version()
 
-        return package_version
+
+def get_package_version() -> str:
+    return _package_version